@@ -0,0 +1,45 @@
+from climpy.bc.ipsl import routing, routing_reference
+
+import numpy
+import timeit
+
+
+def get_plateaus(shape, size=40):
+    """
+    Land with square flat plateaus of size x size cells draining through one cell of their edge
+    """
+    rng = numpy.random.default_rng(0)
+    topo = rng.uniform(100, 200, shape)
+    for i in range(2, shape[0] - size - 2, size + 4):
+        for j in range(2, shape[1] - size - 2, size + 4):
+            topo[i : i + size, j : j + size] = 50.0
+            topo[i + size // 2, j - 1] = 1.0
+    return topo
+
+
+def bench_add_gradient_to_flats(shape, repeat=3):
+    """
+    Best time of the loop based reference, the breadth first search
+    and the breadth first search with the Garbin and Martz gradient
+    """
+    topo = get_plateaus(shape)
+    functions = {
+        "reference": lambda: routing_reference._add_gradient_to_flats(topo.copy()),
+        "vectorized": lambda: routing._add_gradient_to_flats(topo.copy()),
+        "garbin_martz": lambda: routing._add_gradient_to_flats(
+            topo.copy(), garbin_martz=True
+        ),
+    }
+    return {
+        name: min(timeit.repeat(function, number=1, repeat=repeat))
+        for name, function in functions.items()
+    }
+
+
+if __name__ == "__main__":
+    for shape in ((360, 720), (720, 1440)):
+        times = bench_add_gradient_to_flats(shape)
+        print(
+            f"{shape[0]}x{shape[1]}: "
+            + ", ".join(f"{name} {time:.2f}s" for name, time in times.items())
+        )
@@ -0,0 +1,53 @@
+from climpy.bc.ipsl import pft
+
+import numpy
+import os
+import tempfile
+import timeit
+
+
+def bench_update_pft_netcdf(storage, shape=(360, 720), repeat=5):
+    """
+    Best time of generating and writing the PFT file again against updating a copy
+    of the previous file after editing one latitude band
+    """
+    topo = numpy.where(numpy.random.default_rng(0).random(shape) > 0.7, 100.0, -1.0)
+    latitudes = [15, 35, 50, 80, 90]
+    pft_values = numpy.random.default_rng(0).integers(0, 50, (5, 13))
+    new_values = pft_values.copy()
+    new_values[2, 3] += 10
+
+    folder = tempfile.mkdtemp()
+    previous_path = os.path.join(folder, "previous.nc")
+    ds = pft.generate_pft_netcdf(topo, latitudes, pft_values, storage)
+    ds.attrs["topo_checksum"] = "topo"
+    ds.to_netcdf(previous_path, format="NETCDF3_64BIT")
+
+    def generate():
+        pft.generate_pft_netcdf(topo, latitudes, new_values, storage).to_netcdf(
+            os.path.join(folder, "generated.nc"), format="NETCDF3_64BIT"
+        )
+
+    def update():
+        pft.update_pft_netcdf(
+            previous_path,
+            os.path.join(folder, "updated.nc"),
+            shape,
+            latitudes,
+            new_values,
+            storage,
+            "topo",
+        )
+
+    return (
+        min(timeit.repeat(generate, number=1, repeat=repeat)),
+        min(timeit.repeat(update, number=1, repeat=repeat)),
+    )
+
+
+if __name__ == "__main__":
+    for storage in pft.storage_encodings:
+        generate, update = bench_update_pft_netcdf(storage)
+        print(
+            f"{storage}: generate {generate * 1000:.1f}ms, update {update * 1000:.1f}ms"
+        )
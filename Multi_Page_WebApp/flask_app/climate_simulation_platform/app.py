@@ -3,6 +3,7 @@ import zipfile
 import io
 from datetime import datetime
 import platform
+import numpy
 import xarray as xr
 
 import climate_simulation_platform
@@ -70,6 +71,17 @@ def _validate_file(request):
     return file
 
 
+def _is_regular_global_grid(lon, lat):
+    # Routing works at any resolution as long as the cells are evenly spaced over the globe
+    for values, extent in ((lon, 360), (lat, 180)):
+        steps = numpy.diff(numpy.sort(values))
+        if not len(steps) or not numpy.allclose(steps, steps[0]):
+            return False
+        if not numpy.isclose(steps[0] * len(values), extent):
+            return False
+    return True
+
+
 @bp.route("/")
 @login_required
 def index():
@@ -560,9 +572,7 @@ def routing(_id):
         flash(error)
 
     data_shape = tuple(ds.dims.values())
-    show_regrid = False
-    if data_shape != (180, 360):
-        show_regrid = True
+    show_regrid = not _is_regular_global_grid(ds[lon].values, ds[lat].values)
 
     return render_template(
         "app/routing.html",
@@ -2,7 +2,15 @@ from collections import OrderedDict
 import numpy
 
 tasks = {
-    "python": ["regrid", "routing", "heatflow", "ahmcoef", "pft", "invalidate"],
+    "python": [
+        "regrid",
+        "routing",
+        "routing_batch",
+        "heatflow",
+        "ahmcoef",
+        "pft",
+        "invalidate",
+    ],
     "mosaic": ["calculate_weights"],
     "panel": ["internal_oceans", "passage_problems", "subbasins"],
 }
@@ -28,8 +36,13 @@ file_dependancies = {
     "bathy": ["raw"],
     "pft": ["bathy"],
     "routing": ["raw"],
+    "routing_basins": ["raw"],
     "soils": ["raw"],
     "topo_high_res": ["raw"],
+    "routing_batch": ["raw"],
+    "bathy_batch": ["raw"],
+    "soils_batch": ["raw"],
+    "topo_high_res_batch": ["raw"],
     "heatflow": ["bathy"],
     "ahmcoef": ["bathy"],
 }
@@ -1,2 +1,3 @@
 from . import bc
 from . import interactive
+from . import labels
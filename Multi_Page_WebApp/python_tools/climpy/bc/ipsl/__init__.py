@@ -1,4 +1,5 @@
 from . import ahmcoef
+from . import assets
 from . import heatflow
 from . import pft
 from . import routing
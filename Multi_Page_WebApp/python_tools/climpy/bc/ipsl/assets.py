@@ -0,0 +1,52 @@
+import os
+import threading
+
+import numpy
+import xarray as xr
+
+# Files packaged with climpy.bc.ipsl and the options used to open them
+assets = {
+    "geothermal_heatingLMParaT.nc": {"decode_times": False},
+    "paleorca2_40Ma_grid.nc": {},
+    "topo_high_res_y_vals.npy": {},
+}
+
+_loaded = {}
+# The output files can be built by several threads at the same time
+_lock = threading.Lock()
+
+
+def get_asset_path(name):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+
+
+def load_asset(name):
+    """
+    Load a packaged file the first time it is used, the values are kept for the next calls
+    NetCDF files are read in memory and closed straight away. The values are shared so
+    they are read only, datasets are returned as copies so attributes can still be changed
+    """
+    if name not in assets:
+        raise ValueError(f"Unknown asset {name}, should be one of {list(assets)}")
+    with _lock:
+        if name not in _loaded:
+            path = get_asset_path(name)
+            if name.endswith(".nc"):
+                with xr.open_dataset(path, **assets[name]) as ds:
+                    value = ds.load()
+                for variable in value.variables.values():
+                    variable.values.flags.writeable = False
+            else:
+                value = numpy.load(path, **assets[name])
+                value.flags.writeable = False
+            _loaded[name] = value
+    value = _loaded[name]
+    if isinstance(value, xr.Dataset):
+        return value.copy()
+    return value
+
+
+def clear_assets():
+    # Free the memory used by the loaded files, they are loaded again when needed
+    with _lock:
+        _loaded.clear()
@@ -1,60 +1,89 @@
 from datetime import datetime
-import os
 import numpy
+import warnings
 import xarray as xr
-from scipy.ndimage import median_filter
 
+from climpy.bc.ipsl.assets import load_asset
+
+
+def _fill_xy(vals, mask, nb_passes):
+    """
+    Replace the masked values by the median of the values in their 3 x 3 window (NaN are ignored)
+    Only the windows of the masked cells are gathered, the cells with no values around
+    them are filled by the next passes
+    """
+    vals = numpy.array(vals)
+    voids = numpy.flatnonzero(mask)
+    for _ in range(nb_passes):
+        if len(voids) == 0:
+            break
+        rows, cols = numpy.divmod(voids, vals.shape[1])
+        # Like median_filter the edge values are repeated outside the grid
+        windows = numpy.array(
+            [
+                vals[
+                    numpy.clip(rows + di, 0, vals.shape[0] - 1),
+                    numpy.clip(cols + dj, 0, vals.shape[1] - 1),
+                ]
+                for di in (-1, 0, 1)
+                for dj in (-1, 0, 1)
+            ]
+        )
+        with warnings.catch_warnings():
+            # Windows without values give NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            medians = numpy.nanmedian(windows, axis=0)
+        vals.flat[voids] = medians
+        voids = voids[numpy.isnan(medians)]
+    return vals
+
+
+def _calculate_heatflow(bathy):
+    """
+    Heatflow from the bathymetry values (positive depths)
+    The steps are done in place on a few preallocated arrays
+    """
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        # Age of the sea floor, the ages are calculated with the type of bathy
+        # and combined as float64 values
+        sfage = numpy.subtract(bathy, 2600.0)
+        sfage /= 365
+        numpy.square(sfage, out=sfage)
+        sfage = sfage.astype(numpy.float64, copy=False)
+        sfage *= ~(sfage > 20)
+        sfage20 = numpy.subtract(bathy, 5651.0)
+        sfage20 /= -2473
+        numpy.log(sfage20, out=sfage20)
+        sfage20 *= -1 / 0.0278
+        sfage20 = sfage20.astype(numpy.float64, copy=False)
+        sfage20 *= sfage20 >= 20
+        sfage += sfage20
+
+        # Heat in the deep ocean, with the age of the sea floor
+        heat = numpy.sqrt(sfage, out=sfage)
+        numpy.divide(490, heat, out=heat)
+        heat *= bathy > 2500
+        numpy.minimum(heat, 400, out=heat)
+        numpy.copyto(heat, 0, where=~(heat > 0))
+        # Constant heat on the margins
+        numpy.add(heat, 48, out=heat, where=(bathy > 0) & (bathy < 2500))
+
+        # No heat on steep slopes
+        gradxbathy = numpy.abs(numpy.gradient(numpy.gradient(bathy, axis=0), axis=1))
+        heat[(gradxbathy > 500) & (heat > 100)] = 0
+
+    # Ocean cells without values are filled with the values of their neighbors
+    mask_void = numpy.isnan(heat) & (bathy > 0)
+    heat = _fill_xy(heat, mask_void, 2)
+    heat *= bathy > 0
+    return heat
 
-def create_heatflow(ds_bathy_paleo_orca, bathy_var="Bathymetry"):
-    sfage0 = ((ds_bathy_paleo_orca[bathy_var] - 2600.0) / 365) ** 2
-    sfage20 = (-1 / 0.0278) * numpy.log(
-        (ds_bathy_paleo_orca.Bathymetry - 5651.0) / (-2473)
-    )
-
-    masksf0 = xr.where(sfage0 > 20, 0, 1)
-    masksf20 = xr.where(sfage20 >= 20, 1, 0)
-
-    sfage = sfage0 * masksf0 + sfage20 * masksf20
-
-    maskdepth = xr.where(ds_bathy_paleo_orca.Bathymetry > 2500, 1, 0)
-
-    heat0 = 490 / (sfage ** 0.5)
-    heat0m = heat0 * maskdepth
-
-    heat0oc = xr.where(heat0m > 400, 400, heat0m)
-    heat0ma = xr.where(
-        (ds_bathy_paleo_orca.Bathymetry > 0) & (ds_bathy_paleo_orca.Bathymetry < 2500),
-        48,
-        0,
-    )
-    heat0ocm = xr.where(heat0oc > 0, heat0oc, 0)
-    heat0mam = xr.where(heat0ma > 0, heat0ma, 0)
-    heat = heat0ocm + heat0mam
-
-    def xgradient(x):
-        return numpy.abs(numpy.gradient(numpy.gradient(x, axis=0), axis=1))
-
-    gradxbathy = xr.apply_ufunc(xgradient, ds_bathy_paleo_orca.Bathymetry)
-
-    maskbathy = xr.where(ds_bathy_paleo_orca.Bathymetry > 0, 1, 0)
-    maskgrad = xr.where((gradxbathy > 500) & (heat > 100), 0, 1)
-
-    void_heat = xr.where(heat * maskgrad > 0, heat * maskgrad, 0)
-
-    def fill_xy(arr, mask, nb_passes):
-        arr = arr.copy(deep=True)
-        vals = arr.values
-        for _ in range(nb_passes):
-            convolution = median_filter(vals, (3, 3))
-            vals = numpy.where(mask == 1, convolution, vals)
-        arr.values = vals
-        return arr
 
-    mask_void = xr.where(
-        void_heat.isnull() & (ds_bathy_paleo_orca.Bathymetry > 0), 1, 0
+def create_heatflow(ds_bathy_paleo_orca, bathy_var="Bathymetry"):
+    bathy = ds_bathy_paleo_orca[bathy_var]
+    heatflow = xr.DataArray(
+        _calculate_heatflow(bathy.values), coords=bathy.coords, dims=bathy.dims
     )
-    fill_void_heat = fill_xy(void_heat, mask_void, 2)
-    heatflow = fill_void_heat * maskbathy
     ds_out = xr.Dataset()
     ds_out["heatflow"] = heatflow
 
@@ -64,10 +93,7 @@ def create_heatflow(ds_bathy_paleo_orca, bathy_var="Bathymetry"):
     ds_out = ds_out.set_coords(['nav_lon', 'nav_lat'])
 
     # Add time_counter
-    heatflow_file = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)), "geothermal_heatingLMParaT.nc"
-        )
-    ds_model = xr.open_dataset(heatflow_file, decode_times=False)
+    ds_model = load_asset("geothermal_heatingLMParaT.nc")
     # This adds the time_steps variable and time_counter dim
     ds_out["time_steps"] = ds_model["time_steps"]
     ds_out["time_counter"] = ds_model["time_counter"]
@@ -1,8 +1,70 @@
+import netCDF4
 import numpy
+import shutil
 import xarray as xr
 
+# Encodings used to store maxvegetfrac, int8 stores whole percentages
+# (unsigned types are not available in the NETCDF3 files we write)
+storage_encodings = {
+    "float64": {"dtype": "float64"},
+    "float32": {"dtype": "float32"},
+    "int8": {
+        "dtype": "int8",
+        "scale_factor": 0.01,
+        "add_offset": 0.0,
+        "_FillValue": -127,
+    },
+}
 
-def generate_pft_netcdf(topo, latitudes, pft_values):
+
+def _get_row_values(nb_lat, latitudes, pft_values, storage):
+    """
+    Values of the 13 PFTs on each row of a grid with nb_lat rows (North to South)
+    """
+    if storage not in storage_encodings:
+        raise ValueError(
+            f"Unknown PFT storage {storage}, should be one of {list(storage_encodings)}"
+        )
+
+    # Make sure pft values are percentages
+    assert numpy.max(pft_values) <= 100
+    assert numpy.max(pft_values) > 1
+    assert numpy.min(pft_values) >= 0
+
+    # Convert percentages to 0 -> 1 range
+    pft_values = pft_values / 100.0
+    # Only float64 storage needs float64 values in memory
+    if storage != "float64":
+        pft_values = pft_values.astype(numpy.float32)
+
+    def _get_lat_index(val):
+        return int((90 - val) / (180 / nb_lat))
+
+    # Index of the latitude band of each row, rows outside the bands use the last
+    # index which has no vegetation
+    band_of_row = numpy.full(nb_lat, len(latitudes))
+    _from = 0
+    for i in range(len(latitudes)):
+        _to = latitudes[i]
+        # Set one hemisphere
+        band_of_row[_get_lat_index(_to) : _get_lat_index(_from)] = i
+        # Set other hemisphere
+        band_of_row[nb_lat - _get_lat_index(_from) : nb_lat - _get_lat_index(_to)] = i
+        # Go to next latitude
+        _from = _to
+    pft_values = numpy.vstack(
+        [pft_values, numpy.zeros(pft_values.shape[1], dtype=pft_values.dtype)]
+    )
+
+    # Take the values of each row in a single gather
+    return pft_values[band_of_row]
+
+
+def generate_pft_netcdf(topo, latitudes, pft_values, storage="float32"):
+    """
+    Create the PFT file on the grid of topo (North to South, starting from -180 longitude)
+    storage is the way maxvegetfrac is stored in the file (see storage_encodings)
+    """
     # Attribute new PFTs. See lookup table to convert the 10 megabiomes of BIOME4 (Herold
     # GMD 2014, Harrison and Prentice Global Change Biology 2003) into the corresponding
     # 13 PFTs of ORCHIDEE (excluding n°13 and 14)
@@ -29,47 +91,22 @@ def generate_pft_netcdf(topo, latitudes, pft_values):
     # C4     C4 grass
     #
     # see also IPSL/modeles/ORCHIDEE/src_parameters/constantes_mtc.f90
-    assert topo.shape == (360, 720)
-    nb_lat = 360
-    nb_lon = 720
-    arr = numpy.zeros((13, nb_lat, nb_lon))
+    nb_lat, nb_lon = topo.shape
+    row_values = _get_row_values(nb_lat, latitudes, pft_values, storage)
 
-    # Make sure pft values are percentages
-    assert numpy.max(pft_values) <= 100
-    assert numpy.max(pft_values) > 1
-    assert numpy.min(pft_values) >= 0
-
-    # Convert percentages to 0 -> 1 range
-    pft_values = pft_values / 100.0
-
-    def _get_lat_index(val):
-        return int((90 - val) / (180 / nb_lat))
-
-    _from = 0
-    for i in range(len(latitudes)):
-        _to = latitudes[i]
-        for pft_layer in numpy.argwhere(pft_values[i] > 0):
-            # Set one hemisphere
-            arr[pft_layer, _get_lat_index(_to) : _get_lat_index(_from), :] = pft_values[
-                i, pft_layer
-            ]
-            # Set other hemisphere
-            arr[
-                pft_layer,
-                nb_lat - _get_lat_index(_from) : nb_lat - _get_lat_index(_to),
-                :,
-            ] = pft_values[i, pft_layer]
-        # Go to next latitude
-        _from = _to
-
-    # Convert oceans values to NaN values
-    xx, yy = numpy.where(topo <= 0)
-    arr[:, xx, yy] = numpy.nan
+    # Broadcast the values of each row over the longitudes
+    # Oceans values are NaN values
+    arr = numpy.where(
+        topo <= 0,
+        row_values.dtype.type(numpy.nan),
+        row_values.T[:, :, numpy.newaxis],
+    )
 
     ds = xr.Dataset(
         coords={
-            "lat": numpy.arange(89.75, -90, -0.5),
-            "lon": numpy.arange(-179.75, 180, 0.5),
+            # Centers of the cells
+            "lat": 90 - (numpy.arange(nb_lat) + 0.5) * 180 / nb_lat,
+            "lon": (numpy.arange(nb_lon) + 0.5) * 360 / nb_lon - 180,
             "time_counter": [1],
             "veget": numpy.arange(1, 14, dtype=numpy.int32),
         },
@@ -80,6 +117,7 @@ def generate_pft_netcdf(topo, latitudes, pft_values):
             )
         },
     )
+    ds.maxvegetfrac.encoding = dict(storage_encodings[storage])
     ds.lat.attrs = {
         "bounds": "bounds_lat",
         "valid_max": 90.0,
@@ -109,5 +147,79 @@ def generate_pft_netcdf(topo, latitudes, pft_values):
         "valid_min": 1,
         "units": "-",
     }
+    # The table is kept in the file so an edit only writes the changed rows again
+    # (see update_pft_netcdf), netCDF attributes are 1D so the values are flattened
+    ds.attrs["pft_latitudes"] = numpy.asarray(latitudes, dtype=numpy.float64)
+    ds.attrs["pft_values"] = numpy.asarray(pft_values, dtype=numpy.float64).flatten()
+    ds.attrs["pft_storage"] = storage
 
     return ds
+
+
+def _get_stored_values(values, encoding):
+    # Values as they are written in the file, xarray rounds the scaled values
+    if "scale_factor" in encoding:
+        values = numpy.round(
+            (values - encoding["add_offset"]) / encoding["scale_factor"]
+        )
+    return values.astype(encoding["dtype"])
+
+
+def update_pft_netcdf(
+    previous_path,
+    path,
+    shape,
+    latitudes,
+    pft_values,
+    storage="float32",
+    topo_checksum=None,
+):
+    """
+    Write to path the PFT file of previous_path (see generate_pft_netcdf) with a new table of PFT values
+    The file is copied and only the rows of the latitude bands with new values are written again
+    topo_checksum identifies the topography giving the land cells, it is stored in the files
+    Returns False without writing anything when the previous file can not be reused
+    (another topography, grid shape or storage) and the file has to be generated again
+    """
+    with netCDF4.Dataset(previous_path) as nc:
+        attrs = nc.__dict__
+        if (
+            topo_checksum is None
+            or attrs.get("topo_checksum") != topo_checksum
+            or attrs.get("pft_storage") != storage
+            or "pft_values" not in attrs
+            or nc["maxvegetfrac"].shape[-2:] != tuple(shape)
+        ):
+            return False
+        previous_latitudes = numpy.atleast_1d(attrs["pft_latitudes"])
+        previous_values = numpy.atleast_1d(attrs["pft_values"]).reshape(
+            len(previous_latitudes), -1
+        )
+
+    encoding = storage_encodings[storage]
+    row_values = _get_stored_values(
+        _get_row_values(shape[0], latitudes, pft_values, storage), encoding
+    )
+    previous_row_values = _get_stored_values(
+        _get_row_values(shape[0], previous_latitudes, previous_values, storage),
+        encoding,
+    )
+    changed = numpy.any(row_values != previous_row_values, axis=1)
+    # First and last + 1 rows of each block of consecutive changed rows
+    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate([[0], changed, [0]])))
+
+    shutil.copyfile(previous_path, path)
+    with netCDF4.Dataset(path, "a") as nc:
+        maxvegetfrac = nc["maxvegetfrac"]
+        # Read and write the values as they are stored
+        maxvegetfrac.set_auto_maskandscale(False)
+        fill_value = getattr(maxvegetfrac, "_FillValue", numpy.nan)
+        for start, stop in edges.reshape(-1, 2):
+            rows = maxvegetfrac[0, :, start:stop, :]
+            ocean = numpy.isnan(rows) if numpy.isnan(fill_value) else rows == fill_value
+            maxvegetfrac[0, :, start:stop, :] = numpy.where(
+                ocean, rows, row_values[start:stop].T[:, :, numpy.newaxis]
+            )
+        nc.pft_latitudes = numpy.asarray(latitudes, dtype=numpy.float64)
+        nc.pft_values = numpy.asarray(pft_values, dtype=numpy.float64).flatten()
+    return True
@@ -1,13 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
+import hashlib
+import heapq
+import importlib
+import json
 import numpy
+from numpy.lib.stride_tricks import sliding_window_view
 import os
+import resource
+import threading
+import time
+import tracemalloc
 
 from scipy.signal import convolve2d
 from scipy.ndimage import measurements
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 from skimage.morphology import reconstruction
 
 import xarray as xr
 
+from climpy.bc.ipsl.assets import load_asset
+from climpy.labels import merge_dateline_labels, relabel
+
 next_downstream_cell = numpy.array(
     [
         # 0  1  2  3   4   5   6   7   8
@@ -66,87 +82,93 @@ def _fill_depressions_in_topo(dem):
     # This should ensure that water will never run towards to pole
     # We increment the value slightly to ensure it is not flat
     dem[0] = numpy.max(dem[:2], axis=0) + 1.0
-    # Copy the map to either side for east - west periodicity
-    # Rather than hard coding the periodicity as the array is small and
-    # the function runs quickly we fix the topography aligned 3 times next to each other
-    dem = numpy.hstack((dem, dem, dem))
 
-    # Create a pad of one all the way around the dem and set to max value
     # Scipy reconstruction works bby eroding awy the values
     # See here:
     # https://scikit-image.org/docs/dev/auto_examples/features_detection/plot_holes_and_peaks.html#sphx-glr-auto-examples-features-detection-plot-holes-and-peaks-py
-    padded = numpy.pad(dem, 1, "maximum")
-    seed = numpy.copy(padded)
-    # Add borders
-    seed[1:-1, 1:-1] = dem.max() + 1
-
-    filled = reconstruction(seed, padded, method="erosion")
-    # Because we padded the array we need to remove this
-    filled = filled[1:-1, 1:-1]
+    # The borders of the map act as if they were padded with the maximum of each row and column
+    # a cell can always get to the border along its row or column so we start the erosion
+    # from the lowest of the two maximums instead of padding the map
+    seed = numpy.maximum(
+        dem, numpy.minimum(dem.max(axis=1)[:, numpy.newaxis], dem.max(axis=0))
+    )
+
+    # For the east - west periodicity we add a halo of columns from the other side of the map
+    # If the values either side of the date line do not agree the halo is updated and
+    # the reconstruction is run again starting from the previous values
+    halo = max(1, dem.shape[1] // 8)
+    mask = numpy.hstack((dem[:, -halo:], dem, dem[:, :halo]))
+    has_nan = numpy.isnan(dem).any()
+    filled = seed
+    while True:
+        eroded = reconstruction(
+            numpy.hstack((filled[:, -halo:], filled, filled[:, :halo])),
+            mask,
+            method="erosion",
+        )
+        filled = eroded[:, halo:-halo]
+        # Reconstruction never settles with NaN values so we only do one pass with them
+        if has_nan or (
+            numpy.array_equal(eroded[:, halo - 1], filled[:, -1])
+            and numpy.array_equal(eroded[:, -halo], filled[:, 0])
+        ):
+            break
+
     # Reset the ocean -> dont modify the ocean
     filled[dem <= 0] = dem[dem <= 0]
-    # Take the middle array (we stacked 3 of them next to each other)
-    filled = filled[:, int(filled.shape[1] / 3) : 2 * int(filled.shape[1] / 3)]
     return filled
 
 
-def _migrate_front_across_flats(front, arrays, trip_values, iterations, iteration):
-    """
-    Recursive function to propagate values across a front. We use recursion rather than a while loop
-    """
-    # Get the adjacent cells that have the same value as the center cell
-    # arrays is defined below and is a 8 by i by j where 8 corresponds the the different directions
-    # each layer of arrays corresponds to the difference in the trip value
-    # in that direction eg layer one is the differences with cells to the north
-    flat_coords = numpy.argwhere(arrays[:, front[0], front[1]].T == 0)
-    # if there are no more cells with adjacent flat cells then stop the recursion
-    if not len(flat_coords):
-        return
-
-    # Get the adjacent cell coordinates by using where the flat cell is in comparison to the each cell on the front
-    # Downstream cells points to the combination of -1, 0, 1 in each direction that needs adding
-    next_cells = (
-        next_downstream_cell[trip_values[flat_coords[:, 1]]]
-        + front.T[flat_coords[:, 0]]
-    )
-    # Fix the EW periodicity
-    # Replace values that are -1 with the last value
-    next_cells[:, 1] = numpy.where(
-        next_cells[:, 1] == -1, iterations.shape[1] - 1, next_cells[:, 1]
-    )
-    # Replace values that go off the end with 0
-    next_cells[:, 1] = numpy.where(
-        next_cells[:, 1] == iterations.shape[1], 0, next_cells[:, 1]
-    )
-
-    # Remove duplicate cells that can be found from multiple routes
-    # This takes the first occurence each time -> means that the trip values aren't going to be random
-    # They are probably ordered in the following order 6, 5, 4, 7, 0, 3, 8, 1, 2 (trip values order)
-    next_cells, unique_ids = numpy.unique(next_cells, axis=0, return_index=True)
-    # Add the trip values to the next cells this is for consitent filtering
-    next_cells = numpy.hstack(
-        (next_cells, trip_values[flat_coords[unique_ids, 1]].reshape(-1, 1))
-    )
-    # Make sure we don't have any values that go outside the array
-    # TODO this may be casuing problems ??? but hopefully isn't being hit
-    next_cells = next_cells[
-        (next_cells[:, 0] >= 0)
-        & (next_cells[:, 0] < iterations.shape[0])
-        & (next_cells[:, 1] >= 0)
-        & (next_cells[:, 1] < iterations.shape[1])
-    ]
-    # only take values that haven't already been seen
-    # We do this by checking if a value for the cell has been set ->
-    # this means it has been seen in another layer of the recursion
-    # trip values are 1-> 8 this means that anythin 0 or below hasn't been seen
-    next_cells = next_cells[iterations[next_cells[:, 0], next_cells[:, 1]] <= 0]
-    # Change the values of the next cells to their correct trip values (calculated where they came from)
-    iterations[next_cells[:, 0], next_cells[:, 1]] = iteration
-    # Redo this function as many times as necessary
-    iteration += 1
-    return _migrate_front_across_flats(
-        next_cells[:, :2].T, arrays, trip_values, iterations, iteration
-    )
+def _get_neighbours(cells, shape):
+    """
+    Generator giving for each of the 8 directions the cells that have a neighbour
+    in this direction (no North / South wrapping) and the neighbour flat indexs
+    """
+    rows, cols = numpy.divmod(cells, shape[1])
+    for di, dj in next_downstream_cell[trip_values]:
+        neighbour_rows = rows + di
+        inside = (neighbour_rows >= 0) & (neighbour_rows < shape[0])
+        # Handle the East - West periodicity
+        neighbour_cols = (cols[inside] + dj) % shape[1]
+        yield cells[inside], neighbour_rows[inside] * shape[1] + neighbour_cols
+
+
+def _spread_across_flats(topo, sources, allowed=None):
+    """
+    Breadth first search starting from the sources and moving to adjacent cells with the same height
+    Returns the number of steps needed to reach each cell, sources are 1 and cells never reached are 0
+    """
+    values = topo.flatten()
+    index_dtype = _get_index_dtype(topo.size)
+    steps = numpy.zeros(topo.size, dtype=index_dtype)
+    # Each cell is seen at most once so the queue can be allocated once
+    # the cells between start and end are the current front
+    queue = numpy.empty(topo.size, dtype=index_dtype)
+    # Stamp the cells with their position in the candidates to remove duplicates
+    stamps = numpy.empty(topo.size, dtype=index_dtype)
+    start, end = 0, len(sources)
+    queue[start:end] = sources
+    steps[sources] = 1
+    step = 1
+    while start < end:
+        candidates = []
+        for cells, neighbours in _get_neighbours(queue[start:end], topo.shape):
+            neighbours = neighbours[
+                (values[neighbours] == values[cells]) & (steps[neighbours] == 0)
+            ]
+            candidates.append(neighbours)
+        candidates = numpy.concatenate(candidates)
+        if allowed is not None:
+            candidates = candidates[allowed[candidates]]
+        order = numpy.arange(len(candidates))
+        stamps[candidates] = order
+        candidates = candidates[stamps[candidates] == order]
+
+        step += 1
+        steps[candidates] = step
+        start, end = end, end + len(candidates)
+        queue[start:end] = candidates
+    return steps.reshape(topo.shape)
 
 
 def get_differences_with_neighbors(array, ensure_gradient=False):
@@ -179,50 +201,136 @@ def get_differences_with_neighbors(array, ensure_gradient=False):
     return arrays
 
 
-def _add_gradient_to_flats(topo):
+def _get_bands(shape):
     """
-    calculate trip values using matrices rather than loops
+    Split the rows in latitude bands of at most ROUTING_BAND_CELLS cells (at least one row)
+    so the stages looking at the neighbors of each cell use a bounded amount of memory
     """
-    arrays = get_differences_with_neighbors(topo, ensure_gradient=True)
+    rows = max(1, int(os.environ.get("ROUTING_BAND_CELLS", 2**18)) // shape[1])
+    return [
+        slice(start, min(start + rows, shape[0])) for start in range(0, shape[0], rows)
+    ]
+
+
+def _get_band_differences(array, rows, ensure_gradient=False):
+    """
+    Differences with neighbors (see get_differences_with_neighbors) for a band of rows
+    """
+    # Add the rows either side of the band as a halo, on the map edges the padding is the same as before
+    start = max(rows.start - 1, 0)
+    stop = min(rows.stop + 1, array.shape[0])
+    arrays = get_differences_with_neighbors(array[start:stop], ensure_gradient)
+    return arrays[:, rows.start - start : rows.stop - start]
+
+
+def _get_index_dtype(size):
+    # Flat indexes fit in 32 bits for most grids which halves the memory of the flow graph
+    return numpy.int32 if size < 2**31 else numpy.int64
+
+
+# Compact encodings of the stage results used to route with less memory:
+# trip values fit in int8 and basin numbers in int32 with 0 in the ocean instead of NaN
+# and the ocean mask is a boolean array
+compact_dtypes = {
+    "calculate_omsk": bool,
+    "calculate_trip": numpy.int8,
+    "calculate_basins": numpy.int32,
+    "calculate_trip_outflow_values": numpy.int8,
+}
+
+
+def _is_ocean(values):
+    # Ocean cells are NaN in the float encoding and 0 in the compact one
+    if numpy.issubdtype(values.dtype, numpy.floating):
+        return numpy.isnan(values)
+    return values == 0
+
+
+def to_compact(values, dtype):
+    """
+    Convert trip, basins or omsk values to their compact encoding (see compact_dtypes)
+    """
+    if values.dtype == dtype:
+        return values
+    return numpy.where(numpy.isnan(values), 0, values).astype(dtype)
+
+
+def to_legacy(values):
+    """
+    Convert compact trip, basins or omsk values back to floats with NaN in the ocean
+    Any other value is returned as it is
+    """
+    dtype = getattr(values, "dtype", None)
+    if dtype == bool:
+        return values.astype(float)
+    if dtype in (numpy.int8, numpy.int32):
+        return numpy.where(values == 0, numpy.nan, values)
+    return values
+
+
+def _add_gradient_to_flats(topo, garbin_martz=False):
+    """
+    Add a small gradient on flat areas so the water flows towards the exit points
+    With garbin_martz the gradient away from higher terrain is added too (Garbin and Martz 1997)
+    """
+    # Compare each cell with its neighbors, the padded rows are higher so no water goes off the map
+    padded = get_padded_array(topo, ensure_gradient=True)
+    has_lower = numpy.zeros(topo.shape, dtype=bool)
+    has_same = numpy.zeros(topo.shape, dtype=bool)
+    has_higher = numpy.zeros(topo.shape, dtype=bool)
+    for di, dj in next_downstream_cell[trip_values]:
+        neighbors = padded[
+            1 + di : padded.shape[0] - 1 + di, 1 + dj : padded.shape[1] - 1 + dj
+        ]
+        has_lower |= neighbors < topo
+        has_same |= neighbors == topo
+        has_higher |= neighbors > topo
 
     # Fix the values on flats
+    # pas (has_lower) is like in the mountains not quite a col but like a suspended glacial valley
     # There is at least one cell where the water can flow downwards
-    # pas is like in the mountains not quite a col but like a suspended glacial valley
-    is_pas = numpy.sum(arrays > 0, axis=0) > 0
-    # A pas has a least one value that is greater than 0 -> downwards flow
-    # Flats are defined by areas where at least the difference between 2 cells is 0
-    is_flat = numpy.sum(arrays == 0, axis=0) > 0
-
+    # Flats (has_same) are defined by areas where at least the difference between 2 cells is 0
     # Only take land cells
     # TODO maybe we should be passing omsk in to ensure we have the correct values
-    is_pas[topo <= 0] = False
-    is_flat[topo <= 0] = False
+    is_land = topo > 0
 
     # Exit points from flat basins are defined as the points that have the same
     # altitude as a neighbor cell (is_flat) and at least one downward cell (is_pas)
-    exit_points = numpy.array(
-        numpy.where((is_pas == True) & (is_flat == True))  # noqa: E712
-    )
-
-    # Store an array of when the cell was seen for the first time
-    # This is passed to our recursively function and filled over time
-    iterations = numpy.zeros(topo.shape)
-    iteration = 1
-
-    # Add the values to iterations this is so the algo knows that these
-    # cells ahev already been seen and will expand / migrate from here
-    iterations[exit_points[0], exit_points[1]] = iteration
-    iteration += 1
-
-    # Migrate the front across the flats recursively
-    _migrate_front_across_flats(exit_points, arrays, trip_values, iterations, iteration)
-    zeros = numpy.where(iterations == 0)
-    ones = numpy.where(iterations == 1)
-    #     iterations += numpy.random.rand(*iterations.shape) / 100
-    iterations[zeros] = 0
-    iterations[ones] = 1
-    increment = 1.0 / (100 * iterations.max())
-    topo += iterations * increment
+    exit_points = numpy.flatnonzero(has_lower & has_same & is_land)
+
+    # Number of steps from the exit points across the flats
+    # 1 for the exit points and 0 for the cells not on a flat
+    gradient = _spread_across_flats(topo, exit_points)
+
+    if garbin_martz:
+        on_flat = gradient > 0
+        # High edges are the cells of a flat next to higher terrain that are not exit points
+        high_edges = numpy.flatnonzero(has_higher & ~has_lower & on_flat)
+        away = _spread_across_flats(topo, high_edges, allowed=on_flat.flatten())
+
+        # The gradient away from higher terrain is highest next to the high edges
+        # so we reverse the number of steps using the furthest cell of each flat
+        values = topo.flatten()
+        cells = numpy.flatnonzero(on_flat)
+        edges = list(_get_neighbours(cells, topo.shape))
+        from_cells = numpy.concatenate([edge[0] for edge in edges])
+        neighbours = numpy.concatenate([edge[1] for edge in edges])
+        same = values[from_cells] == values[neighbours]
+        graph = csr_matrix(
+            (numpy.ones(same.sum(), dtype=bool), (from_cells[same], neighbours[same])),
+            shape=(topo.size, topo.size),
+        )
+        flats = connected_components(graph, directed=False)[1].reshape(topo.shape)
+        flat_heights = numpy.zeros(flats.max() + 1, dtype=int)
+        numpy.maximum.at(flat_heights, flats[on_flat], away[on_flat])
+        away = numpy.where(away > 0, flat_heights[flats] - away + 1, 0)
+
+        # Combine both gradients, the gradient towards the exits is doubled so it wins
+        gradient = 2 * gradient + away
+
+    if gradient.max() > 0:
+        increment = 1.0 / (100 * gradient.max())
+        topo += gradient * increment
 
     return topo
 
@@ -237,13 +345,13 @@ def _ensure_south_up(topo, latitudes):
     raise AssertionError("Can not find South, latitude values do not vary across 0")
 
 
-def fix_topo(topo, latitudes):
+def fix_topo(topo, latitudes, garbin_martz=False):
     topo = topo.copy()
     # Some files with trailing float problems (1e-14) have been observed this should fix that
     topo = numpy.round(topo, 3)
     topo = _ensure_south_up(topo, latitudes)
     topo = _fill_depressions_in_topo(topo)
-    topo = _add_gradient_to_flats(topo)
+    topo = _add_gradient_to_flats(topo, garbin_martz=garbin_martz)
     return topo
 
 
@@ -284,49 +392,21 @@ def calculate_continents(topo, omsk):
 
     # Calculate the continents measurements returns a list of distinct objects in the image
     continents = measurements.label(~omsk.astype(bool))[0]
-    # Take a look at the edges and see where continents are different and should be the same due to cyclicite
-    difference_long_180 = numpy.argwhere(
-        (continents[:, 0] != continents[:, -1])
-        &  # Check first column and last column are the same
-        # Make sure the first column isn't ocean -> last column is a coast
-        (continents[:, 0] != 0)
-        &
-        # Make sure the last column isn't ocean -> first column is a coast
-        (continents[:, -1] != 0)
-    ).flatten()
-    same_continents = []
-    for d in difference_long_180:
-        vals = [continents[d, 0], continents[d, -1]]
-        inserted = False
-        for i in range(len(same_continents)):
-            conts = same_continents[i]
-            # At least one of the values already exists in a list
-            if len(set(vals) & set(conts)):
-                conts.extend(vals)
-                same_continents[i] = list(set(conts))
-                inserted = True
-                break
-        # If the continents haven't already been seen then add a new continent to the list
-        if not inserted:
-            same_continents.append(vals)
-
-    for cont in same_continents:
-        # Replace all values in continents with the first value
-        for i in range(1, len(cont)):
-            continents[continents == cont[i]] = cont[0]
-    return continents
+    # Continents crossing the dateline are split in two by the labelling
+    return merge_dateline_labels(continents)
 
 
 def calculate_trip(topo, omsk):
     """
     calculate trip values using matrices rather than loops
     """
-    arrays = get_differences_with_neighbors(topo, ensure_gradient=True)
-
-    # Find the index of the biggest value -> direction of descent if multiple values occur it takes the smallest (first seen)
-    ind = numpy.argmax(arrays, axis=0)
-    # Convert indexs to trip values
-    rtm = trip_values[ind].astype(float)
+    rtm = numpy.zeros(topo.shape)
+    for rows in _get_bands(topo.shape):
+        arrays = _get_band_differences(topo, rows, ensure_gradient=True)
+        # Find the index of the biggest value -> direction of descent if multiple values occur it takes the smallest (first seen)
+        ind = numpy.argmax(arrays, axis=0)
+        # Convert indexs to trip values
+        rtm[rows] = trip_values[ind]
     # only take rtm values on land
     rtm[omsk == True] = numpy.nan  # noqa: E712
 
@@ -340,93 +420,139 @@ def calculate_trip(topo, omsk):
     return rtm
 
 
-def calculate_curvilinear_coordinates():
+def _get_coordinates(shape):
+    """
+    Latitudes (South to North) and longitudes of the cell centers of a regular global grid
+    """
+    lat = -90 + (numpy.arange(shape[0]) + 0.5) * 180.0 / shape[0]
+    lon = -180 + (numpy.arange(shape[1]) + 0.5) * 360.0 / shape[1]
+    return lat, lon
+
+
+def calculate_curvilinear_coordinates(shape=(180, 360)):
     # Calculate longigtude and latitude array
-    rlon = numpy.arange(-179.5, 180.5)
-    rlat = numpy.arange(89.5, -90.5, -1)
-    return numpy.meshgrid(rlon, rlat)
+    lat, lon = _get_coordinates(shape)
+    return numpy.meshgrid(lon, lat[::-1])
 
 
 def _calculate_dx(rlat):
+    # The cells of a regular global grid are 360 / nb of longitudes degrees wide
     rEarth = 6370
-    return (2 * numpy.pi * rEarth * numpy.cos(rlat * numpy.pi / 180)) / 360.0
+    return (2 * numpy.pi * rEarth * numpy.cos(rlat * numpy.pi / 180)) / rlat.shape[1]
 
 
-def _calculate_dy():
+def _calculate_dy(rlat):
     rEarth = 6370
-    return (numpy.pi * rEarth) / 180
+    return (numpy.pi * rEarth) / rlat.shape[0]
 
 
 def calculate_area(rlat):
-    dy = _calculate_dy()
+    dy = _calculate_dy(rlat)
     dx = _calculate_dx(rlat)
     area = dx * dy
     return area
 
 
-def get_next_cell(cells, temp_array, trip):
-    """
-    Recursive function that from an given cell will find all the next down stream cells using trip values
-    """
-    ii, jj = cells[-1]
+def _get_next_indices(trip):
+    # Flat index of the next cell following trip values, ocean cells point to -1
+    is_land = ~_is_ocean(trip)
+    ii, jj = numpy.nonzero(is_land)
     # Subscripts pointing on the next cell (downstream) following trip value
-    downstream_direction = next_downstream_cell[int(trip[ii, jj])]
-    # Add the indexs to the original values
-    ip1 = ii + downstream_direction[0]
-    jp1 = jj + downstream_direction[1]
+    downstream_direction = next_downstream_cell[trip[ii, jj].astype(int)]
+    ip1 = ii + downstream_direction[:, 0]
     # Handle periodicity
-    if jp1 < 0:
-        jp1 = temp_array.shape[1] - 1
-    if jp1 >= temp_array.shape[1]:
-        jp1 = 0
-    next_cell = (ip1, jp1)
-    if ip1 >= temp_array.shape[0] or ip1 < 0:
-        raise AssertionError(f"{datetime.now()} Shouldn't be here, {ii}, {jj}")
-        print(f" {datetime.now()} Shouldn't be here, {ii}, {jj}")
-        return cells, "outside", next_cell
-    # If the next cell is ocean then we are done
-    if numpy.isnan(trip[next_cell]):
-        return cells, "ocean", next_cell
-    # If the next cell already has a value then we are done
-    if temp_array[next_cell] != 0:
-        return cells, "junction", next_cell
-
-    # We have already come across this cell lets see if we can find a different output
-    if next_cell in cells:
-        return cells, "infinite_loop", next_cell
-
-    cells.append(next_cell)
-    return get_next_cell(cells, temp_array, trip)
+    jp1 = (jj + downstream_direction[:, 1]) % trip.shape[1]
+    outside = (ip1 >= trip.shape[0]) | (ip1 < 0)
+    if numpy.any(outside):
+        raise AssertionError(
+            f"{datetime.now()} Shouldn't be here, {ii[outside][0]}, {jj[outside][0]}"
+        )
+    next_cells = numpy.full(trip.size, -1, dtype=_get_index_dtype(trip.size))
+    next_cells[numpy.ravel_multi_index((ii, jj), trip.shape)] = numpy.ravel_multi_index(
+        (ip1, jp1), trip.shape
+    )
+    return next_cells
+
+
+def get_downstream_indices(trip):
+    """
+    Flat index of the next downstream cell for every cell using trip values
+    Ocean cells and cells flowing into the ocean point to -1
+    """
+    next_cells = _get_next_indices(trip)
+    is_land = ~_is_ocean(trip.flatten())
+    return numpy.where(is_land[next_cells] & (next_cells >= 0), next_cells, -1)
+
+
+def get_upstream_levels(downstream):
+    """
+    Group the cells by the number of steps needed to reach the ocean following the flow
+    The first level holds the cells flowing into the ocean, each next level holds the cells
+    flowing into the previous one. Cells caught in a loop are never reached
+    """
+    has_downstream = numpy.flatnonzero(downstream >= 0)
+    # Reverse the flow graph: each row holds the cells flowing into the row cell
+    upstream = csr_matrix(
+        (
+            numpy.ones(len(has_downstream), dtype=bool),
+            (downstream[has_downstream], has_downstream),
+        ),
+        shape=(downstream.size, downstream.size),
+    )
+    levels = []
+    level = numpy.flatnonzero(downstream == -1)
+    while len(level):
+        levels.append(level)
+        level = upstream[level].indices
+    return levels
+
+
+def _get_highest_first(topo, land):
+    # Order the cells like numpy.argmax would find them, highest first then by index
+    return land[numpy.argsort(-topo.flatten()[land], kind="stable")]
+
+
+def _get_flow_groups(trip):
+    """
+    Label each land cell with the group of cells connected to it following the flow
+    """
+    downstream = get_downstream_indices(trip)
+    land = numpy.flatnonzero(~_is_ocean(trip))
+    # Each land cell is linked to its downstream land cell, a basin is a group of connected cells
+    # Every group ends either at a cell flowing into the ocean or at a loop
+    has_downstream = land[downstream[land] >= 0]
+    graph = csr_matrix(
+        (
+            numpy.ones(len(has_downstream), dtype=bool),
+            (has_downstream, downstream[has_downstream]),
+        ),
+        shape=(trip.size, trip.size),
+    )
+    return connected_components(graph, directed=True, connection="weak")[1]
 
 
 def calculate_basins(topo, trip, area):
-    # create dummy array
-    basins = numpy.zeros(topo.shape)
-    # Find the highest point
-    highest_point = numpy.unravel_index(
-        numpy.where(basins == 0, topo, -9999).argmax(), topo.shape
-    )
-
-    # Setup a basin number
-    basin_nb = 1
-
-    # While we still have points that are on land (higher than 0)
-    #  calculate the runoff cells from this high point
-    while topo[highest_point] > 0:
-        # Get cells connected to current cell
-        cells, end_reason, next_cell = get_next_cell([highest_point], basins, trip)
-        x, y = numpy.array(cells).T
-        # If we hit a junction then we need to adjust all the values
-        if end_reason == "junction":
-            basins[x, y] = basins[next_cell]
-        else:
-            # Set value to a new basin
-            basins[x, y] = basin_nb
-            basin_nb += 1
-        # Calculate the next highest point
-        highest_point = numpy.unravel_index(
-            numpy.where(basins == 0, topo, -9999).argmax(), topo.shape
-        )
+    return _number_basins(topo, trip, _get_flow_groups(trip), area)
+
+
+def _number_basins(topo, trip, groups, area):
+    """
+    Give the basin numbers to the groups of land cells (flat array of group labels)
+    """
+    land = numpy.flatnonzero(~_is_ocean(trip))
+
+    # Number the basins in the order they are seen when walking down from the highest point
+    seen_groups, first_seen = numpy.unique(
+        groups[_get_highest_first(topo, land)], return_index=True
+    )
+    basin_numbers = numpy.zeros(groups.max() + 1)
+    basin_numbers[seen_groups[numpy.argsort(first_seen)]] = numpy.arange(
+        1, len(seen_groups) + 1
+    )
+
+    basins = numpy.zeros(topo.size)
+    basins[land] = basin_numbers[groups[land]]
+    basins = basins.reshape(topo.shape)
 
     # Rarrange by the area
     # We use bincount with weights corresponding to the area of each cell
@@ -434,8 +560,12 @@ def calculate_basins(topo, trip, area):
     # We sort the cells by size
     sorted_sizes = numpy.argsort(sizes)[::-1]
     # We assign the new value
-    for i in range(len(sorted_sizes)):
-        basins[basins == sorted_sizes[i]] = -i
+    lut = numpy.zeros(len(sorted_sizes))
+    lut[sorted_sizes] = -numpy.arange(len(sorted_sizes))
+    # Renumbering one basin at a time the cells of the largest basin (set to 0)
+    # were then numbered with the ocean, keep the same numbers
+    lut[sorted_sizes[0]] = lut[0]
+    basins = relabel(basins.astype(int), lut)
 
     # REplace ocean with zeros
     basins[basins == 0] = numpy.nan
@@ -446,7 +576,7 @@ def calculate_basins(topo, trip, area):
 
 def calculate_ocean_distances(trip, rlat):
     dx = _calculate_dx(rlat)
-    dy = _calculate_dy()
+    dy = _calculate_dy(rlat)
     # Creat Distance for each cell based on trip values
     trip_distances = numpy.array(
         [
@@ -463,7 +593,7 @@ def calculate_ocean_distances(trip, rlat):
         ]
     )
 
-    temp_trip = numpy.where(~numpy.isnan(trip), trip.astype(int), 0)
+    temp_trip = numpy.where(~_is_ocean(trip), trip.astype(int), 0)
     xx, yy = numpy.ix_(numpy.arange(trip.shape[0]), numpy.arange(trip.shape[1]))
     distances = trip_distances[temp_trip, xx, yy]
     distances[distances == 0] = numpy.nan
@@ -476,80 +606,86 @@ def calculate_outflow_points(basins, trip):
     # They could be calculated using minimum topo height inside each basin but this has problems
     # When the outflow point is at the same height as other points
     # Considering we are following flow directions we will just store the values
-    outflow_points = []
-    for basin_nb in range(
-        numpy.nanmin(basins).astype(int), numpy.nanmax(basins).astype(int) + 1
-    ):
-        nboutflow = 0
-        outloc = [numpy.nan, numpy.nan]
-
-        # Calculate the nb of outflow points
-        x, y = numpy.where(basins == basin_nb)
-        for k in range(len(x)):
-            i, j = x[k], y[k]
-            downstream_direction = next_downstream_cell[int(trip[i, j])]
-            # Add the indexs to the original values
-            ip1 = i + downstream_direction[0]
-            jp1 = j + downstream_direction[1]
-            # Handle periodicity
-            if jp1 < 0:
-                jp1 = basins.shape[1] - 1
-            if jp1 >= basins.shape[1]:
-                jp1 = 0
-            next_cell = (ip1, jp1)
-            if ~numpy.isnan(trip[i, j]) & numpy.isnan(trip[next_cell]):
-                if outloc != [i, j]:
-                    outloc = [i, j]
-                    nboutflow += 1
-        outflow_points.append(outloc)
-
-        if nboutflow > 1:
+    # Outflow points are the land cells flowing into the ocean
+    outflow_cells = numpy.flatnonzero(
+        ~_is_ocean(trip.flatten())
+        & ~_is_ocean(basins.flatten())
+        & (get_downstream_indices(trip) == -1)
+    )
+    outflow_basins = basins.flatten()[outflow_cells].astype(int)
+
+    # Calculate the nb of outflow points for each basin
+    land_basins = basins[~_is_ocean(basins)]
+    first_basin = int(land_basins.min())
+    nboutflow = numpy.bincount(
+        outflow_basins - first_basin,
+        minlength=int(land_basins.max()) - first_basin + 1,
+    )
+    if numpy.any(nboutflow != 1):
+        basin_nb = numpy.argmax(nboutflow != 1) + first_basin
+        if nboutflow[basin_nb - first_basin] > 1:
             raise AssertionError(
                 "error occured to many outflow points for basin {}".format(basin_nb)
             )
-            print("error occured to many outflow points")
-        elif nboutflow == 0:
-            raise AssertionError("No outflow points for basin {}".format(basin_nb))
-            print("No outflow points for basin {}".format(basin_nb))
+        raise AssertionError("No outflow points for basin {}".format(basin_nb))
 
-    outflow_points = numpy.array(outflow_points)
+    # Order the outflow points by basin number
+    outflow_points = numpy.array(
+        numpy.unravel_index(
+            outflow_cells[numpy.argsort(outflow_basins, kind="stable")], trip.shape
+        )
+    ).T
     return outflow_points
 
 
 def calculate_river_lengths(topo, trip, ocean_distances, omsk):
-    # create dummy array
-    flength = numpy.zeros(trip.shape)
-    # Find the highest point
-    highest_point = numpy.unravel_index(
-        numpy.where(flength == 0, topo, -9999).argmax(), topo.shape
-    )
-
-    # While we still have points higher than 0 calculate the runoff cells from this high point
-    while topo[highest_point] > 0:
-        # Get cells connected to current cell
-        cells, end_reason, next_cell = get_next_cell([highest_point], flength, trip)
-        # We reverse the order of cells because the last one seen is the closest to the ocean
-        x, y = numpy.array(cells[::-1]).T
-        # We take the distance according to trip in each cell to the next cell
-        # We calculate the cumlative sum along the flow path
-        flow_lengths = numpy.cumsum(ocean_distances[x, y])
-
-        if end_reason == "junction":
-            # If we hit a junction then we need to adjust all the values because we are not starting at 0
-            flength[x, y] = flength[next_cell] + flow_lengths
-        elif end_reason == "ocean":
-            # The outlet is an ocean
-            flength[x, y] = flow_lengths
-
-        else:
-            raise AssertionError(
-                f"Unexpected end reason {end_reason} for river starting at {highest_point}"
-            )
-        # Calculate the next highest point
+    downstream = get_downstream_indices(trip)
+    levels = get_upstream_levels(downstream)
+    # Levels start from the ocean so we only keep land cells
+    levels[0] = levels[0][~_is_ocean(trip.flatten()[levels[0]])]
+    land = numpy.flatnonzero(~_is_ocean(trip))
+    highest_first = _get_highest_first(topo, land)
+
+    # Cells that never reach the ocean are in a loop
+    reached = numpy.zeros(trip.size, dtype=bool)
+    reached[numpy.concatenate(levels)] = True
+    if not numpy.all(reached[land]):
         highest_point = numpy.unravel_index(
-            numpy.where(flength == 0, topo, -9999).argmax(), topo.shape
+            highest_first[~reached[highest_first]][0], trip.shape
+        )
+        raise AssertionError(
+            f"Unexpected end reason infinite_loop for river starting at {highest_point}"
+        )
+
+    # Rivers are summed from the ocean upwards, to get exactly the same values as when
+    # walking down the rivers from the highest point each cell keeps track of the highest
+    # point it is reached from (source) and the sums are restarted when the source changes
+    source = numpy.full(trip.size, trip.size, dtype=_get_index_dtype(trip.size + 1))
+    source[highest_first] = numpy.arange(len(highest_first))
+    for level in levels[:0:-1]:
+        numpy.minimum.at(source, downstream[level], source[level])
+
+    distances = ocean_distances.flatten()
+    # Length from the cell to the point where the river joins another one
+    flow_lengths = numpy.zeros(trip.size)
+    # Length from the joining point to the ocean
+    junction_lengths = numpy.zeros(trip.size)
+    flength = numpy.zeros(trip.size)
+
+    flow_lengths[levels[0]] = distances[levels[0]]
+    flength[levels[0]] = flow_lengths[levels[0]]
+    for level in levels[1:]:
+        next_cells = downstream[level]
+        same_river = source[level] == source[next_cells]
+        flow_lengths[level] = (
+            numpy.where(same_river, flow_lengths[next_cells], 0) + distances[level]
+        )
+        junction_lengths[level] = numpy.where(
+            same_river, junction_lengths[next_cells], flength[next_cells]
         )
+        flength[level] = junction_lengths[level] + flow_lengths[level]
 
+    flength = flength.reshape(trip.shape)
     # Add nan values for the ocean
     flength[omsk == 1] = numpy.nan
     return flength
@@ -559,81 +695,116 @@ def calculate_distbox(flength, trip):
     # Set the distance to ocean inside the ocean to 0
     tmp_flength = numpy.where(~numpy.isnan(flength), flength, 0)
 
-    diffs = get_differences_with_neighbors(tmp_flength, ensure_gradient=True)
-
-    xx, yy = numpy.ix_(numpy.arange(trip.shape[0]), numpy.arange(trip.shape[1]))
     # For trip values in the 1 -> range we calculate the difference between the cell and the nexy downstream cell
-    assert numpy.nanmin(trip) > 0
-    assert numpy.nanmax(trip) < 9
-    distbox = (
-        diffs[numpy.where(~numpy.isnan(trip), trip - 1, 0).astype(int), xx, yy] * 1000
-    )
+    is_land = ~_is_ocean(trip)
+    assert numpy.all(trip[is_land] > 0)
+    assert numpy.all(trip[is_land] < 9)
+    directions = numpy.where(is_land, trip - 1, 0).astype(int)
+
+    distbox = numpy.zeros(trip.shape)
+    for rows in _get_bands(trip.shape):
+        diffs = _get_band_differences(tmp_flength, rows, ensure_gradient=True)
+        xx, yy = numpy.ix_(numpy.arange(diffs.shape[1]), numpy.arange(trip.shape[1]))
+        distbox[rows] = diffs[directions[rows], xx, yy] * 1000
     return distbox
 
 
+def _set_outflow_box(i, j, trip, basins):
+    """
+    Spread the outflow point over a 2 x 2 box when the 4 cells are in the same basin with
+    the same trip value. Returns the coordinates of the modified cells
+    """
+    adjacent_coords = get_adjacent_coords(i, j, trip)
+    ip1, jp1 = numpy.max(adjacent_coords, axis=0)
+    im1, jm1 = numpy.min(adjacent_coords, axis=0)
+
+    adjacent_basins_values = get_adjacent_values(i, j, basins)
+    basbas = [
+        adjacent_basins_values[1, 1],
+        adjacent_basins_values[2, 2],
+        adjacent_basins_values[1, 2],
+        adjacent_basins_values[2, 1],
+    ]
+
+    adjacent_trip_values = get_adjacent_values(i, j, trip)
+    trptrp = [
+        adjacent_trip_values[1, 1],
+        adjacent_trip_values[2, 2],
+        adjacent_trip_values[1, 2],
+        adjacent_trip_values[2, 1],
+    ]
+
+    if not (((basbas == basbas[0]).sum() == 4) & ((trptrp == trptrp[0]).sum() == 4)):
+        return []
+
+    # Count how many ocean cells are in each of the corners
+    ocean_in_box = [
+        (~_is_ocean(get_adjacent_values(im1, jm1, basins))).sum(),  # Upper left
+        # Upper right
+        (~_is_ocean(get_adjacent_values(im1, jp1, basins))).sum(),
+        # Lower Right
+        (~_is_ocean(get_adjacent_values(ip1, jp1, basins))).sum(),
+        (~_is_ocean(get_adjacent_values(ip1, jm1, basins))).sum(),  # Lower Left
+    ]
+    li = numpy.argmax(ocean_in_box)
+    if li == 0:
+        trip[i, j] = 9
+        trip[ip1, j] = 7
+        trip[ip1, jp1] = 8
+        trip[i, jp1] = 1
+    elif li == 1:
+        trip[i, j] = 3
+        trip[ip1, j] = 9
+        trip[ip1, jp1] = 1
+        trip[i, jp1] = 2
+    elif li == 2:
+        trip[i, j] = 4
+        trip[ip1, j] = 5
+        trip[ip1, jp1] = 9
+        trip[i, jp1] = 3
+    else:
+        trip[i, j] = 5
+        trip[ip1, j] = 6
+        trip[ip1, jp1] = 7
+        trip[i, jp1] = 9
+    return [(i, j), (ip1, j), (ip1, jp1), (i, jp1)]
+
+
 def calculate_trip_outflow_values(trip, outflow_points, basins, omsk, rlat):
     trip = trip.copy()
     trip[outflow_points[:, 0], outflow_points[:, 1]] = 9
 
     x, y = outflow_points.T
 
-    for k in range(len(x)):
-        i, j = x[k], y[k]
-        adjacent_coords = get_adjacent_coords(i, j, trip)
-        ip1, jp1 = numpy.max(adjacent_coords, axis=0)
-        im1, jm1 = numpy.min(adjacent_coords, axis=0)
-
-        adjacent_basins_values = get_adjacent_values(i, j, basins)
-        basbas = [
-            adjacent_basins_values[1, 1],
-            adjacent_basins_values[2, 2],
-            adjacent_basins_values[1, 2],
-            adjacent_basins_values[2, 1],
-        ]
-
-        adjacent_trip_values = get_adjacent_values(i, j, trip)
-        trptrp = [
-            adjacent_trip_values[1, 1],
-            adjacent_trip_values[2, 2],
-            adjacent_trip_values[1, 2],
-            adjacent_trip_values[2, 1],
-        ]
+    # Get the 2 x 2 boxes with the outflow points in the upper left corner
+    # the padded arrays have the same periodicity as get_adjacent_values
+    def _get_boxes(arr):
+        return sliding_window_view(get_padded_array(arr), (2, 2))[x + 1, y + 1].reshape(
+            -1, 4
+        )
 
-        if ((basbas == basbas[0]).sum() == 4) & ((trptrp == trptrp[0]).sum() == 4):
-            # Count how many ocean cells are in each of the corners
-            ocean_in_box = [
-                (
-                    ~numpy.isnan(get_adjacent_values(im1, jm1, basins))
-                ).sum(),  # Upper left
-                # Upper right
-                (~numpy.isnan(get_adjacent_values(im1, jp1, basins))).sum(),
-                # Lower Right
-                (~numpy.isnan(get_adjacent_values(ip1, jp1, basins))).sum(),
-                (
-                    ~numpy.isnan(get_adjacent_values(ip1, jm1, basins))
-                ).sum(),  # Lower Left
-            ]
-            li = numpy.argmax(ocean_in_box)
-            if li == 0:
-                trip[i, j] = 9
-                trip[ip1, j] = 7
-                trip[ip1, jp1] = 8
-                trip[i, jp1] = 1
-            elif li == 1:
-                trip[i, j] = 3
-                trip[ip1, j] = 9
-                trip[ip1, jp1] = 1
-                trip[i, jp1] = 2
-            elif li == 2:
-                trip[i, j] = 4
-                trip[ip1, j] = 5
-                trip[ip1, jp1] = 9
-                trip[i, jp1] = 3
-            else:
-                trip[i, j] = 5
-                trip[ip1, j] = 6
-                trip[ip1, jp1] = 7
-                trip[i, jp1] = 9
+    def _is_same_in_box(arr):
+        boxes = _get_boxes(arr)
+        return numpy.all(boxes == boxes[:, :1], axis=1)
+
+    # Look at all the boxes at once, setting a box modifies the trip values
+    # so after that we check the following boxes containing a modified cell again
+    box_cells = _get_boxes(numpy.arange(trip.size).reshape(trip.shape))
+    to_check = list(numpy.flatnonzero(_is_same_in_box(basins) & _is_same_in_box(trip)))
+    checked = -1
+    while to_check:
+        k = heapq.heappop(to_check)
+        if k <= checked:
+            continue
+        checked = k
+        modified_cells = _set_outflow_box(x[k], y[k], trip, basins)
+        if modified_cells:
+            modified_cells = numpy.ravel_multi_index(
+                tuple(numpy.array(modified_cells).T), trip.shape
+            )
+            later = numpy.isin(box_cells[k + 1 :], modified_cells).any(axis=1)
+            for other in k + 1 + numpy.flatnonzero(later):
+                heapq.heappush(to_check, other)
 
     # We have modified the outflow points in the last part of code so outflow points are no longer correct
     # We need to find trip values equal to 9
@@ -643,55 +814,43 @@ def calculate_trip_outflow_values(trip, outflow_points, basins, omsk, rlat):
     # If we don't pad twice then we will have problems on the borders
     padded_omsk = get_padded_array(omsk)  # pad 1 value
     padded_omsk = get_padded_array(padded_omsk)  # pad 2 value
+    # To get the five values centered on i, j we need to go from i - 2 -> i + 3
+    # has we have padded twice the window starting at i, j is centered on the point
+    omsk_bx = sliding_window_view(padded_omsk, (5, 5))[x, y]
+
+    # If there is at least one ocean point then it is a coastal or river flow
+    # Ocean values are 1 in omsk
+    is_ocean_flow = numpy.sum(omsk_bx, axis=(1, 2)) > 0
+    # Otherwise this can only be an internal basin
+    is_internal = numpy.sum(omsk_bx < 0.5, axis=(1, 2)) > 0
+    # Not sure we every hit this?
+    if not numpy.all(is_ocean_flow | is_internal):
+        raise AssertionError(
+            "We have an ouflow point but we can not say if it is return flow or flow to the ocean"
+        )
 
-    padded_trip = get_padded_array(trip)  # pad 1 value
-    padded_trip = get_padded_array(padded_trip)  # pad 2 value
-
-    for k in range(len(x)):
-        i, j = x[k], y[k]
-        # To get the five values centered on i, j we need to go from i - 2 -> i + 3
-        # has we have padded twice we need to add 2 so the indexs match
-        omsk_bx = padded_omsk[i - 2 + 2 : i + 3 + 2, j - 2 + 2 : j + 3 + 2]
-        trip_bx = padded_trip[i - 2 + 2 : i + 3 + 2, j - 2 + 2 : j + 3 + 2]
-
-        # If there is at least one ocean point then it is a coastal or river flow
-        # Ocean values are 1 in omsk
-        if numpy.sum(omsk_bx) > 0:
-            # The first 200 basins are river flow else it is coastal flow
-            if basins[i, j] < 200:
-                trip[i, j] = 99
-            else:
-                trip[i, j] = 98
-        elif numpy.sum(omsk_bx < 0.5) > 0:
-            # This can only be an internal basin
-            # Greenland is still a problem as we have coarse resolution coast lines
-            # Thus anything north of 60deg N will be coastal flow
-            if rlat[i, j] > 60:
-                trip[i, j] = 98
-            else:
-                trip[i, j] = 97
-        # Not sure we every hit this?
-        else:
-            raise AssertionError(
-                "We have an ouflow point but we can not say if it is return flow or flow to the ocean"
-            )
-            print(
-                "We have an ouflow point but we can not say if it is return flow or flow to the ocean"
-            )
-            print(i, j)
-            print(omsk_bx)
-            print(trip_bx)
-
+    trip[x, y] = numpy.where(
+        is_ocean_flow,
+        # The first 200 basins are river flow else it is coastal flow
+        numpy.where(basins[x, y] < 200, 99, 98),
+        # Greenland is still a problem as we have coarse resolution coast lines
+        # Thus anything north of 60deg N will be coastal flow
+        numpy.where(rlat[x, y] > 60, 98, 97),
+    )
     return trip
 
 
 def calculate_dzz(topo, trip, distbox, omsk):
 
-    height_differences = get_differences_with_neighbors(topo, ensure_gradient=True)
-
-    xx, yy = numpy.ix_(numpy.arange(trip.shape[0]), numpy.arange(trip.shape[1]))
     # For trip values in the 1 -> range we calculate the difference between the cell and the nexy downstream cell
-    dzz = height_differences[numpy.where(trip < 50, trip - 1, 0).astype(int), xx, yy]
+    directions = numpy.where((trip < 50) & ~_is_ocean(trip), trip - 1, 0).astype(int)
+    dzz = numpy.zeros(trip.shape)
+    for rows in _get_bands(trip.shape):
+        height_differences = _get_band_differences(topo, rows, ensure_gradient=True)
+        xx, yy = numpy.ix_(
+            numpy.arange(height_differences.shape[1]), numpy.arange(trip.shape[1])
+        )
+        dzz[rows] = height_differences[directions[rows], xx, yy]
     # For trip values corresponding to outlets we just take the topo value
     dzz = numpy.where(trip > 50, topo, dzz)
     # If values are less than 5 then clip them to "avoid unpleasant surprises"
@@ -713,6 +872,33 @@ def calculate_topo_index(distbox, dzz, omsk):
     return topoindex
 
 
+def calculate_basin_summary(topo, trip, basins, area):
+    """
+    Table of the basins, the values of basin n are at index n - 1:
+    area, number of cells, mean height, flat index of the outlet cell and its trip value
+    (97 to 99 see calculate_trip_outflow_values), -1 and 0 for basins without an outlet
+    Basins are the groups of cells flowing together so they never flow into another basin
+    """
+    in_basin = ~_is_ocean(basins)
+    cells = numpy.flatnonzero(in_basin)
+    index = basins.flatten()[cells].astype(int) - 1
+    nb_basins = index.max() + 1 if len(index) else 0
+
+    nb_cells = numpy.bincount(index, minlength=nb_basins)
+    basin_area = numpy.bincount(index, area.flatten()[cells], minlength=nb_basins)
+    height = numpy.bincount(index, topo.flatten()[cells], minlength=nb_basins)
+    height = numpy.divide(
+        height, nb_cells, out=numpy.full(nb_basins, numpy.nan), where=nb_cells > 0
+    )
+
+    # The outlets are the only cells with a trip value above 50 in each basin
+    outlets = numpy.flatnonzero(in_basin & (trip > 50))
+    outlet = numpy.full(nb_basins, -1)
+    outlet[basins.flatten()[outlets].astype(int) - 1] = outlets
+    outflow = numpy.where(outlet >= 0, trip.flatten()[outlet], 0)
+    return basin_area, nb_cells, height, outlet, outflow
+
+
 def _set_attributes_ds_routing(ds_routing):
     ds_routing["nav_lon"].attrs = {
         "units": "degrees_east",
@@ -780,8 +966,8 @@ def create_routing_netcdf(
             "nav_lat": (["y", "x"], rlat),
         },
         data_vars={
-            "trip": (["y", "x"], trip[::-1]),
-            "basins": (["y", "x"], basins[::-1]),
+            "trip": (["y", "x"], to_legacy(trip)[::-1]),
+            "basins": (["y", "x"], to_legacy(basins)[::-1]),
             "topoind": (["y", "x"], topo_index[::-1]),
             "hdiff": (["y", "x"], dzz[::-1]),
             "riverl": (["y", "x"], distbox[::-1]),
@@ -791,9 +977,84 @@ def create_routing_netcdf(
         },
     )
     ds_routing = _set_attributes_ds_routing(ds_routing)
+    ds_routing.attrs["routing_checksum"] = _get_routing_checksum(ds_routing)
     return ds_routing
 
 
+def _get_routing_checksum(ds_routing):
+    """
+    Hash of the code and of the values update_routing reuses from a routing file
+    A file edited by hand or created by another version of the code does not match it
+    """
+    values = [ds_routing[name].values for name in ("topo", "basins", "disto")]
+    return get_cache_key(
+        get_code_key(),
+        *[numpy.isnan(value) for value in values],
+        *[numpy.nan_to_num(value).astype(numpy.float64) for value in values],
+    )
+
+
+def _set_attributes_ds_basins(ds_basins):
+    ds_basins["basin"].attrs = {
+        "units": "",
+        "long_name": "Basin number",
+    }
+    ds_basins["area"].attrs = {
+        "units": "km2",
+        "long_name": "Area of the basin",
+    }
+    ds_basins["cells"].attrs = {
+        "units": "",
+        "long_name": "Number of grid boxes of the basin",
+    }
+    ds_basins["height"].attrs = {
+        "units": "m",
+        "long_name": "Mean height of the basin",
+    }
+    ds_basins["outlet_y"].attrs = {
+        "units": "",
+        "long_name": "y index of the outflow box in the routing file (-1 if none)",
+    }
+    ds_basins["outlet_x"].attrs = {
+        "units": "",
+        "long_name": "x index of the outflow box in the routing file (-1 if none)",
+    }
+    ds_basins["outflow"].attrs = {
+        "units": "",
+        "long_name": "Trip value of the outflow box (0 if none)",
+    }
+    return ds_basins
+
+
+def create_basin_summary(ds_routing):
+    """
+    Table of the basins of a routing file (see calculate_basin_summary) along a basin dimension
+    It is not part of the routing file so that file only has variables on the map
+    """
+    topo, trip, basins = [
+        ds_routing[name].values for name in ("topo", "trip", "basins")
+    ]
+    basin_area, nb_cells, height, outlet, outflow = calculate_basin_summary(
+        topo, trip, basins, calculate_area(ds_routing.nav_lat.values)
+    )
+    outlet_y, outlet_x = numpy.divmod(outlet, topo.shape[1])
+    outlet_y = numpy.where(outlet >= 0, outlet_y, -1)
+    outlet_x = numpy.where(outlet >= 0, outlet_x, -1)
+    ds_basins = xr.Dataset(
+        coords={"basin": numpy.arange(1, len(outlet) + 1)},
+        data_vars={
+            "area": (["basin"], basin_area),
+            "cells": (["basin"], nb_cells.astype(numpy.int32)),
+            "height": (["basin"], height),
+            "outlet_y": (["basin"], outlet_y.astype(numpy.int32)),
+            "outlet_x": (["basin"], outlet_x.astype(numpy.int32)),
+            "outflow": (["basin"], outflow.astype(numpy.int8)),
+        },
+    )
+    ds_basins = _set_attributes_ds_basins(ds_basins)
+    return ds_basins
+
+
 def create_bathy_paleo_orca(topo, custom_orca=None):
     # Transform topo to bathy and mask land
     bathy = topo * -1
@@ -804,10 +1065,7 @@ def create_bathy_paleo_orca(topo, custom_orca=None):
     # Remap to nemo grid
     # Load grid
     if custom_orca is None:
-        orca_file = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)), "paleorca2_40Ma_grid.nc"
-        )
-        ds_orca = xr.open_dataset(orca_file)
+        ds_orca = load_asset("paleorca2_40Ma_grid.nc")
     else:
         ds_orca = custom_orca
     # Remove the missing value encoding fields as this causes problems because _FillValues is set to nan
@@ -819,12 +1077,10 @@ def create_bathy_paleo_orca(topo, custom_orca=None):
         del ds_orca.lon.encoding["missing_value"]
     except KeyError:
         pass
-    # create output dataset
-    ds = xr.Dataset(
-        coords={"lat": numpy.arange(-89.5, 90), "lon": numpy.arange(-179.5, 180)},
-        data_vars={"Bathymetry": (["lat", "lon"], bathy)},
-    )
-    ds = ds.interp(ds_orca.coords, method="nearest", kwargs={"fill_value": None})
+    # create output dataset, each ORCA point takes the value of the nearest cell
+    index = get_remap_index(bathy.shape, ds_orca)
+    values = numpy.where(index >= 0, bathy.flatten()[index], numpy.nan)
+    ds = xr.Dataset({"Bathymetry": index.copy(data=values)})
     ds = ds.rename({"lat": "nav_lat", "lon": "nav_lon"})
     ds.nav_lat.attrs = {
         "standard_name": "latitude",
@@ -841,20 +1097,73 @@ def create_bathy_paleo_orca(topo, custom_orca=None):
     return ds
 
 
+# Remapping indexes of the last grids used, the ORCA grid is the same for most runs
+_remap_indexes = {}
+
+
+def _calculate_remap_index(shape, ds_orca):
+    # Interpolating the indexes picks the same cells as interpolating the values
+    lat, lon = _get_coordinates(shape)
+    ds = xr.Dataset(
+        coords={"lat": lat, "lon": lon},
+        data_vars={
+            "index": (
+                ["lat", "lon"],
+                numpy.arange(numpy.prod(shape)).reshape(shape),
+            )
+        },
+    )
+    remapped = ds.interp(ds_orca.coords, method="nearest", kwargs={"fill_value": None})
+    remapped = remapped["index"]
+    return numpy.nan_to_num(remapped.values, nan=-1).astype(int), remapped.dims
+
+
+def get_remap_index(shape, ds_orca):
+    """
+    Flat index of the nearest cell of a regular global grid with the given shape for each
+    point of the ORCA grid (-1 where the ORCA coordinates are missing)
+    The indexes are kept in memory and cached in ROUTING_CACHE_DIR keyed on the grid values
+    and the code of this module
+    """
+    key = get_cache_key(
+        "remap",
+        get_code_key(),
+        numpy.array(shape),
+        *[
+            value
+            for name in sorted(ds_orca.coords)
+            for value in (name, ds_orca.coords[name].values)
+        ],
+    )
+    cache_dir = os.environ.get("ROUTING_CACHE_DIR")
+    path = None if cache_dir is None else os.path.join(cache_dir, f"{key}.npz")
+    if key in _remap_indexes:
+        index, dims = _remap_indexes.pop(key)
+    else:
+        cached = None if path is None else _load_cache(path)
+        if cached is not None:
+            index, dims = cached["index"], tuple(cached["dims"])
+        else:
+            index, dims = _calculate_remap_index(shape, ds_orca)
+            if path is not None:
+                _save_cache(path, index=index, dims=numpy.array(dims))
+
+    # Keep the last grids used in memory
+    _remap_indexes[key] = index, dims
+    if len(_remap_indexes) > 8:
+        del _remap_indexes[next(iter(_remap_indexes))]
+    return xr.DataArray(index, dims=dims, coords=ds_orca.coords)
+
+
 def create_topo_high_res(topo):
     # load new coordinates
     lon_vals = numpy.arange(-180 + (360.0 / 2160.0) / 2, 180, 360.0 / 2160)
     # Y values are funky so are stored in a file
-    y_file = os.path.join(
-        os.path.dirname(os.path.abspath(__file__)), "topo_high_res_y_vals.npy"
-    )
-    lat_vals = numpy.load(y_file)
+    lat_vals = load_asset("topo_high_res_y_vals.npy")
     # create output dataset
+    lat, lon = _get_coordinates(topo.shape)
     ds = xr.Dataset(
-        coords={
-            "latitude": numpy.arange(-89.5, 90),
-            "longitude": numpy.arange(-179.5, 180),
-        },
+        coords={"latitude": lat, "longitude": lon},
         data_vars={"RELIEF": (["latitude", "longitude"], topo)},
     )
     ds = ds.interp(
@@ -932,45 +1241,785 @@ def create_soils(rlat, rlon, omsk):
     return ds
 
 
-def run_routines(topo, latitudes, custom_orca=None):
+# The routing stages can be run with different backends
+# A backend is a module defining some of the stages, the stages it doesn't define
+# use the functions of this module. The reference backend has the original loop
+# based implementations, it is slower but the faster stages are checked against it
+# Version of the cached files, change it when the way the results are stored changes
+cache_version = 1
+_code_keys = {}
+backends = {
+    "vectorized": __name__,
+    "reference": "climpy.bc.ipsl.routing_reference",
+}
+default_backend = "vectorized"
+stages = (
+    "fix_topo",
+    "calculate_orog",
+    "calculate_omsk",
+    "calculate_trip",
+    "calculate_curvilinear_coordinates",
+    "calculate_area",
+    "calculate_basins",
+    "calculate_ocean_distances",
+    "calculate_river_lengths",
+    "calculate_distbox",
+    "calculate_outflow_points",
+    "calculate_trip_outflow_values",
+    "calculate_dzz",
+    "calculate_topo_index",
+)
+
+
+def get_backend(stage, backend=None):
+    """
+    Get the name of the backend running a stage, backend can be a name or a dictionary of stage names to names
+    Otherwise the ROUTING_BACKEND_<STAGE> then ROUTING_BACKEND environment variables are used
+    """
+    if isinstance(backend, dict):
+        backend = backend.get(stage)
+    if backend is None:
+        backend = os.environ.get(
+            f"ROUTING_BACKEND_{stage.upper()}",
+            os.environ.get("ROUTING_BACKEND", default_backend),
+        )
+    if backend not in backends:
+        raise ValueError(
+            f"Unknown routing backend {backend}, should be one of {list(backends)}"
+        )
+    return backend
+
+
+def get_stage(stage, backend=None):
+    """
+    Get the function running a stage with the chosen backend (see get_backend)
+    """
+    if stage not in stages:
+        raise ValueError(f"Unknown routing stage {stage}, should be one of {stages}")
+    module = importlib.import_module(backends[get_backend(stage, backend)])
+    return getattr(module, stage, globals()[stage])
+
+
+def get_code_key(module_name=__name__):
+    """
+    Key of the code of a routing module, it is part of every cache key so results
+    calculated by an older version of the code are never loaded
+    The source of this module is always included as the other backends use its helpers
+    """
+    if module_name not in _code_keys:
+        key = hashlib.sha256(str(cache_version).encode())
+        for name in dict.fromkeys((__name__, module_name)):
+            with open(importlib.import_module(name).__file__, "rb") as f:
+                key.update(f.read())
+        _code_keys[module_name] = key.hexdigest()
+    return _code_keys[module_name]
+
+
+def get_cache_key(*values):
+    """
+    Hash of the values used as a key in the stage cache, strings are used as they are
+    and arrays with their type and shape
+    """
+    key = hashlib.sha256()
+    for value in values:
+        if isinstance(value, str):
+            key.update(value.encode())
+        else:
+            value = numpy.ascontiguousarray(value)
+            key.update(f"{value.dtype}{value.shape}".encode())
+            key.update(value.tobytes())
+    return key.hexdigest()
+
+
+def _evict_cache(cache_dir):
+    """
+    Remove the least recently used results until the cache is smaller than ROUTING_CACHE_SIZE (in MB)
+    Other workers can remove the same results at the same time, results already gone are skipped
+    """
+    max_size = float(os.environ.get("ROUTING_CACHE_SIZE", 500)) * 1024**2
+    stats = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".npz"):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        stats.append((stat.st_mtime, stat.st_size, path))
+    # Loading a result updates its modification time so the oldest are the least used
+    stats.sort(reverse=True)
+    size = 0
+    for _, file_size, path in stats:
+        size += file_size
+        if size > max_size:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def _load_cache(path):
+    """
+    Arrays of a cached result or None when it is not in the cache
+    The result can be removed by another worker at any time, that is a cache miss too
+    """
+    try:
+        with numpy.load(path) as cached:
+            arrays = {name: cached[name] for name in cached.files}
+    except FileNotFoundError:
+        return None
+    try:
+        # Mark the result as recently used
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return arrays
+
+
+def _save_cache(path, **arrays):
+    """
+    Store a result in the cache and evict the least recently used ones
+    """
+    cache_dir = os.path.dirname(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first so other workers never load part of a result
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            numpy.savez(f, **arrays)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    _evict_cache(cache_dir)
+
+
+class RoutingProfile:
+    """
+    Wall time, CPU time and memory of each stage of a routing run
+    The context (file id, ...) is added to the records, each record is also printed as a JSON line
+    With trace_memory tracemalloc is started while stages are measured (when it is not already
+    tracing) and each record has the peak memory allocated during the stage (peak_allocated),
+    the memory still allocated at the end (allocated) and the number of memory blocks
+    still allocated at the end (allocated_blocks), all compared to the start of the stage
+    process_peak_rss_increase is the increase of the peak resident memory of the whole process,
+    it only grows when the stage uses more memory than any earlier code of the process
+    When several stages are measured at the same time in different threads (see run_routines)
+    the memory values include the allocations of all of them
+    """
+
+    def __init__(self, log=True, trace_memory=False, **context):
+        self.context = context
+        self.log = log
+        self.trace_memory = trace_memory
+        self.stages = []
+        # The output files are built by several threads at the same time
+        self._lock = threading.Lock()
+        # Number of stages being measured and whether the profile started tracemalloc
+        self._measuring = 0
+        self._started_tracing = False
+
+    def _start_tracing(self):
+        # Returns whether tracemalloc traces the stage and whether it has just been started
+        with self._lock:
+            started = (
+                self.trace_memory
+                and self._measuring == 0
+                and not tracemalloc.is_tracing()
+            )
+            if started:
+                tracemalloc.start()
+                self._started_tracing = True
+            self._measuring += 1
+            return tracemalloc.is_tracing(), started
+
+    def _stop_tracing(self):
+        # tracemalloc is stopped when the last stage measured ends
+        with self._lock:
+            self._measuring -= 1
+            if self._measuring == 0 and self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+
+    @contextmanager
+    def measure(self, stage, **details):
+        """
+        Measure the code run in the with block, the yielded dictionary can be filled with more details
+        """
+        details = dict(stage=stage, **details)
+        tracing, started = self._start_tracing()
+        try:
+            if tracing:
+                # Without reset_peak (Python < 3.9) the peak is only known from the start of tracing
+                has_peak = started or hasattr(tracemalloc, "reset_peak")
+                if not started and has_peak:
+                    tracemalloc.reset_peak()
+                start_blocks = len(tracemalloc.take_snapshot().traces)
+                start_traced = tracemalloc.get_traced_memory()[0]
+            # ru_maxrss is in kilobytes on Linux
+            start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start_wall, start_cpu = time.perf_counter(), time.thread_time()
+            yield details
+            details["wall_time"] = time.perf_counter() - start_wall
+            details["cpu_time"] = time.thread_time() - start_cpu
+            details["process_peak_rss_increase"] = (
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+            ) * 1024
+            if tracing:
+                traced, peak = tracemalloc.get_traced_memory()
+                details["allocated"] = traced - start_traced
+                details["allocated_blocks"] = (
+                    len(tracemalloc.take_snapshot().traces) - start_blocks
+                )
+                if has_peak:
+                    details["peak_allocated"] = peak - start_traced
+        finally:
+            self._stop_tracing()
+        with self._lock:
+            self.stages.append(details)
+        if self.log:
+            print(
+                json.dumps({"routing_profile": {**self.context, **details}}), flush=True
+            )
+
+    def to_dict(self):
+        return {**self.context, "stages": list(self.stages)}
+
+    def summary(self):
+        # One line per stage, used as the revision info
+        return "\n".join(
+            f"{details['stage']}: {details['wall_time']:.2f}s wall, "
+            f"{details['cpu_time']:.2f}s CPU, "
+            + (
+                f"{details['peak_allocated'] / 1024**2:.1f}MB peak allocated, "
+                if "peak_allocated" in details
+                else ""
+            )
+            + (
+                f"{details['allocated_blocks']} blocks still allocated, "
+                if "allocated_blocks" in details
+                else ""
+            )
+            + f"{details['process_peak_rss_increase'] / 1024**2:.1f}MB"
+            " process peak RSS increase"
+            for details in self.stages
+        )
+
+
+def _measure(profile, stage, **details):
+    # Measure a stage when a profile is given
+    if profile is None:
+        return nullcontext(details)
+    return profile.measure(stage, **details)
+
+
+class CacheMissError(LookupError):
+    """
+    Raised when a stage run with cached_only has no cached results
+    """
+
+
+def _run_cached_stage(
+    stage, backend, *arguments, compact=False, profile=None, cached_only=False
+):
+    """
+    Run a stage or load its results from the cache in the ROUTING_CACHE_DIR directory
+    The arguments are (value, key) pairs, the result key is computed from the stage,
+    its backend, the code of the backend (see get_code_key) and the argument keys
+    so we never need to hash the intermediate values
+    With compact the results are stored with the compact encodings (see compact_dtypes)
+    With cached_only a CacheMissError is raised instead of running the stage
+    The stage is measured when a profile is given (see RoutingProfile)
+    Returns the result and its key (a tuple of keys when the stage returns a tuple)
+    """
+    backend = get_backend(stage, backend)
+    key = get_cache_key(
+        stage,
+        backend,
+        get_code_key(backends[backend]),
+        "compact" if compact else "",
+        *[argument[1] for argument in arguments],
+    )
+    cache_dir = os.environ.get("ROUTING_CACHE_DIR")
+    path = None if cache_dir is None else os.path.join(cache_dir, f"{key}.npz")
+
+    with _measure(profile, stage, backend=backend, cached=False) as details:
+        cached = None if path is None else _load_cache(path)
+        if cached is not None:
+            result = [cached[f"result_{i}"] for i in range(len(cached) - 1)]
+            is_tuple = bool(cached["is_tuple"])
+            details["cached"] = True
+            print(f" [c] {datetime.now()} Loaded {stage} from cache", flush=True)
+        elif cached_only:
+            raise CacheMissError(f"{stage} is not cached")
+        else:
+            values = [argument[0] for argument in arguments]
+            # Only the stages of this module understand the compact encodings
+            if compact and backends[backend] != __name__:
+                values = [to_legacy(value) for value in values]
+            result = get_stage(stage, backend)(*values)
+            if compact and stage in compact_dtypes:
+                result = to_compact(result, compact_dtypes[stage])
+            is_tuple = isinstance(result, (tuple, list))
+            if not is_tuple:
+                result = [result]
+            if path is not None:
+                _save_cache(
+                    path,
+                    is_tuple=is_tuple,
+                    **{f"result_{i}": value for i, value in enumerate(result)},
+                )
+
+    if is_tuple:
+        return tuple(result), tuple(
+            get_cache_key(key, str(i)) for i in range(len(result))
+        )
+    return result[0], key
+
+
+def _use_compact():
+    return os.environ.get("ROUTING_COMPACT", "").lower() in ("1", "true", "yes")
+
+
+def _use_garbin_martz():
+    return os.environ.get("ROUTING_GARBIN_MARTZ", "").lower() in ("1", "true", "yes")
+
+
+def _get_fix_topo_arguments(topo, latitudes, backend, garbin_martz):
+    # The option is only part of the cache key when it is used so the cached results stay valid
+    arguments = [(topo, get_cache_key(topo)), (latitudes, get_cache_key(latitudes))]
+    if garbin_martz:
+        if get_backend("fix_topo", backend) != "vectorized":
+            raise ValueError(
+                "Only the vectorized fix_topo adds the Garbin and Martz gradient"
+            )
+        arguments.append((True, "garbin_martz"))
+    return arguments
+
+
+def _calculate_grid(
+    shape, backend=None, compact=False, profile=None, cached_only=False
+):
+    """
+    Coordinates and areas of the grid cells, they only depend on the shape of the topography
+    Returns rlon and the (value, key) pairs of rlat and area (see _run_cached_stage)
+    """
+    print(f" [c] {datetime.now()} Calculating curvilinear coords", flush=True)
+    (rlon, rlat), (_, rlat_key) = _run_cached_stage(
+        "calculate_curvilinear_coordinates",
+        backend,
+        (shape, get_cache_key(numpy.array(shape))),
+        compact=compact,
+        profile=profile,
+        cached_only=cached_only,
+    )
+    print(f" [c] {datetime.now()} Calculating grid area", flush=True)
+    area, area_key = _run_cached_stage(
+        "calculate_area",
+        backend,
+        (rlat, rlat_key),
+        compact=compact,
+        profile=profile,
+        cached_only=cached_only,
+    )
+    return rlon, (rlat, rlat_key), (area, area_key)
+
+
+def _calculate_routing(
+    topo,
+    latitudes,
+    backend=None,
+    compact=None,
+    grid=None,
+    profile=None,
+    cached_only=False,
+    garbin_martz=None,
+):
+    """
+    Run all the routing stages, the stage results are cached on disk when ROUTING_CACHE_DIR is set
+    With compact (by default the ROUTING_COMPACT environment variable) the trip, basins and
+    ocean mask values are kept with the compact encodings until the routing file is created
+    With garbin_martz (by default the ROUTING_GARBIN_MARTZ environment variable) the flats
+    also get the gradient away from higher terrain (see _add_gradient_to_flats)
+    grid can be given to reuse the values of _calculate_grid for topographies of the same shape
+    The stages are measured when a profile is given (see RoutingProfile)
+    With cached_only a CacheMissError is raised as soon as a stage is not cached
+    """
+    if compact is None:
+        compact = _use_compact()
+    if garbin_martz is None:
+        garbin_martz = _use_garbin_martz()
     print(f" [c] {datetime.now()} Fixing Topo", flush=True)
-    topo = fix_topo(topo, latitudes)
+    topo, topo_key = _run_cached_stage(
+        "fix_topo",
+        backend,
+        *_get_fix_topo_arguments(topo, latitudes, backend, garbin_martz),
+        compact=compact,
+        profile=profile,
+        cached_only=cached_only,
+    )
     print(f" [c] {datetime.now()} Calculating orogen", flush=True)
-    orog = calculate_orog(topo)
+    orog, _ = _run_cached_stage(
+        "calculate_orog",
+        backend,
+        (topo, topo_key),
+        compact=compact,
+        profile=profile,
+        cached_only=cached_only,
+    )
     print(f" [c] {datetime.now()} Calculating Ocean Mask", flush=True)
-    omsk = calculate_omsk(topo)
+    omsk, omsk_key = _run_cached_stage(
+        "calculate_omsk",
+        backend,
+        (topo, topo_key),
+        compact=compact,
+        profile=profile,
+        cached_only=cached_only,
+    )
     print(f" [c] {datetime.now()} Calculating runoff directions", flush=True)
-    trip = calculate_trip(topo, omsk)
-    print(f" [c] {datetime.now()} Calculating curvilinear coords", flush=True)
-    rlon, rlat = calculate_curvilinear_coordinates()
-    print(f" [c] {datetime.now()} Calculating grid area", flush=True)
-    area = calculate_area(rlat)
+    trip, trip_key = _run_cached_stage(
+        "calculate_trip",
+        backend,
+        (topo, topo_key),
+        (omsk, omsk_key),
+        compact=compact,
+        profile=profile,
+        cached_only=cached_only,
+    )
+    if grid is None:
+        grid = _calculate_grid(topo.shape, backend, compact, profile, cached_only)
+    rlon, (rlat, rlat_key), (area, area_key) = grid
     print(f" [c] {datetime.now()} Calculating Runoff basins", flush=True)
-    basins = calculate_basins(topo, trip, area)
+    basins, basins_key = _run_cached_stage(
+        "calculate_basins",
+        backend,
+        (topo, topo_key),
+        (trip, trip_key),
+        (area, area_key),
+        compact=compact,
+        profile=profile,
+        cached_only=cached_only,
+    )
     print(f" [c] {datetime.now()} Calculating distance to ocean", flush=True)
-    ocean_distances = calculate_ocean_distances(trip, rlat)
+    ocean_distances, ocean_distances_key = _run_cached_stage(
+        "calculate_ocean_distances",
+        backend,
+        (trip, trip_key),
+        (rlat, rlat_key),
+        compact=compact,
+        profile=profile,
+        cached_only=cached_only,
+    )
     print(f" [c] {datetime.now()} Calculating length of rivers", flush=True)
-    river_length = calculate_river_lengths(topo, trip, ocean_distances, omsk)
+    river_length, river_length_key = _run_cached_stage(
+        "calculate_river_lengths",
+        backend,
+        (topo, topo_key),
+        (trip, trip_key),
+        (ocean_distances, ocean_distances_key),
+        (omsk, omsk_key),
+        compact=compact,
+        profile=profile,
+        cached_only=cached_only,
+    )
     print(f" [c] {datetime.now()} Calculating Distbox", flush=True)
-    distbox = calculate_distbox(river_length, trip)
+    distbox, distbox_key = _run_cached_stage(
+        "calculate_distbox",
+        backend,
+        (river_length, river_length_key),
+        (trip, trip_key),
+        compact=compact,
+        profile=profile,
+        cached_only=cached_only,
+    )
     print(f" [c] {datetime.now()} Calculating outflow points", flush=True)
-    outflow_points = calculate_outflow_points(basins, trip)
+    outflow_points, outflow_points_key = _run_cached_stage(
+        "calculate_outflow_points",
+        backend,
+        (basins, basins_key),
+        (trip, trip_key),
+        compact=compact,
+        profile=profile,
+        cached_only=cached_only,
+    )
     print(f" [c] {datetime.now()} Calculating Trip Values", flush=True)
-    trip = calculate_trip_outflow_values(trip, outflow_points, basins, omsk, rlat)
+    trip, trip_key = _run_cached_stage(
+        "calculate_trip_outflow_values",
+        backend,
+        (trip, trip_key),
+        (outflow_points, outflow_points_key),
+        (basins, basins_key),
+        (omsk, omsk_key),
+        (rlat, rlat_key),
+        compact=compact,
+        profile=profile,
+        cached_only=cached_only,
+    )
     print(f" [c] {datetime.now()} Calculating dzz", flush=True)
-    dzz = calculate_dzz(topo, trip, distbox, omsk)
+    dzz, dzz_key = _run_cached_stage(
+        "calculate_dzz",
+        backend,
+        (topo, topo_key),
+        (trip, trip_key),
+        (distbox, distbox_key),
+        (omsk, omsk_key),
+        compact=compact,
+        profile=profile,
+        cached_only=cached_only,
+    )
     print(f" [c] {datetime.now()} Calculating topo_index", flush=True)
-    topo_index = calculate_topo_index(distbox, dzz, omsk)
+    topo_index, _ = _run_cached_stage(
+        "calculate_topo_index",
+        backend,
+        (distbox, distbox_key),
+        (dzz, dzz_key),
+        (omsk, omsk_key),
+        compact=compact,
+        profile=profile,
+        cached_only=cached_only,
+    )
 
     print(f" [c] {datetime.now()} Creating routing file", flush=True)
-    ds_routing = create_routing_netcdf(
+    with _measure(profile, "create_routing_netcdf"):
+        ds_routing = create_routing_netcdf(
+            topo, trip, basins, topo_index, dzz, distbox, orog, river_length, rlat, rlon
+        )
+    return ds_routing
+
+
+def update_routing(
+    ds_routing, topo, latitudes, changed=None, backend=None, garbin_martz=None
+):
+    """
+    Update a routing dataset (see create_routing_netcdf) after the topography has been edited
+    Only the basins touched by the edit are routed again, the other values come from ds_routing
+    changed is an optional mask of the edited cells, the cells where the fixed topography
+    is different are always used. Returns None when the edit can not be handled this way
+    and a full run is needed: ds_routing was edited or created by another version of the code,
+    a stage uses another backend than the vectorized one, the coast line moved, a river now
+    flows into another basin or more than ROUTING_UPDATE_FRACTION (by default 0.25)
+    of the land has to be routed again
+    garbin_martz is the option of fix_topo (see _calculate_routing)
+    """
+    if garbin_martz is None:
+        garbin_martz = _use_garbin_martz()
+    # Only the vectorized stages can be run on the affected basins alone
+    if any(get_backend(stage, backend) != "vectorized" for stage in stages):
+        return None
+    try:
+        if ds_routing.attrs.get("routing_checksum") != _get_routing_checksum(
+            ds_routing
+        ):
+            return None
+        previous_topo = ds_routing.topo.values[::-1]
+        previous_basins = ds_routing.basins.values[::-1]
+        previous_flength = ds_routing.disto.values[::-1]
+    except KeyError:
+        return None
+
+    topo = get_stage("fix_topo", backend)(topo, latitudes, garbin_martz)
+    if topo.shape != previous_topo.shape:
+        return None
+    omsk = get_stage("calculate_omsk", backend)(topo)
+    if not numpy.array_equal(omsk, get_stage("calculate_omsk", backend)(previous_topo)):
+        return None
+
+    edited = topo != previous_topo
+    if changed is not None:
+        edited |= _ensure_south_up(changed, latitudes)
+    # Trip values depend on the 3 x 3 neighborhood so the cells next to the edit can change too
+    edited = sliding_window_view(get_padded_array(edited), (3, 3)).any(axis=(2, 3))
+    # Route again the basins touched by the edit, the other rivers stay the same
+    affected = numpy.isin(previous_basins, numpy.unique(previous_basins[edited]))
+    # Routing most of the land again is slower than a full run
+    max_fraction = float(os.environ.get("ROUTING_UPDATE_FRACTION", 0.25))
+    if affected.sum() > max_fraction * (~_is_ocean(previous_basins)).sum():
+        return None
+
+    trip = get_stage("calculate_trip", backend)(topo, omsk)
+    downstream = get_downstream_indices(trip).reshape(trip.shape)[affected]
+    if numpy.any(~affected.flat[downstream[downstream >= 0]]):
+        return None
+    # Everything outside the affected basins is seen as ocean
+    affected_trip = numpy.where(affected, trip, numpy.nan)
+    affected_omsk = numpy.where(affected, omsk, 1)
+
+    rlon, rlat = get_stage("calculate_curvilinear_coordinates", backend)(topo.shape)
+    area = get_stage("calculate_area", backend)(rlat)
+    # The groups of the other basins are their previous numbers, the new groups come after them
+    groups = numpy.nan_to_num(previous_basins, nan=0).astype(int)
+    groups[affected] = (
+        _get_flow_groups(affected_trip).reshape(trip.shape)[affected] + groups.max() + 1
+    )
+    basins = _number_basins(topo, trip, groups.flatten(), area)
+
+    ocean_distances = get_stage("calculate_ocean_distances", backend)(
+        affected_trip, rlat
+    )
+    river_length = get_stage("calculate_river_lengths", backend)(
+        topo, affected_trip, ocean_distances, affected_omsk
+    )
+    river_length = numpy.where(affected, river_length, previous_flength)
+
+    # The remaining stages are cheap so they are run on the whole map
+    orog = get_stage("calculate_orog", backend)(topo)
+    distbox = get_stage("calculate_distbox", backend)(river_length, trip)
+    outflow_points = get_stage("calculate_outflow_points", backend)(basins, trip)
+    trip = get_stage("calculate_trip_outflow_values", backend)(
+        trip, outflow_points, basins, omsk, rlat
+    )
+    dzz = get_stage("calculate_dzz", backend)(topo, trip, distbox, omsk)
+    topo_index = get_stage("calculate_topo_index", backend)(distbox, dzz, omsk)
+    return create_routing_netcdf(
         topo, trip, basins, topo_index, dzz, distbox, orog, river_length, rlat, rlon
     )
-    print(f" [c] {datetime.now()} Creating Bathy file", flush=True)
-    ds_bathy = create_bathy_paleo_orca(topo, custom_orca)
-    print(f" [c] {datetime.now()} Creating Soils file", flush=True)
-    ds_soils = create_soils(rlat, rlon, omsk)
-    print(f" [c] {datetime.now()} Creating High Res file", flush=True)
-    ds_topo_high_res = create_topo_high_res(topo)
 
-    return ds_routing, ds_bathy, ds_soils, ds_topo_high_res
+
+def _run_measured(profile, function, *arguments):
+    # The CPU time is measured in the thread running the function
+    with _measure(profile, function.__name__):
+        return function(*arguments)
+
+
+def run_routines(
+    topo,
+    latitudes,
+    custom_orca=None,
+    backend=None,
+    previous=None,
+    changed=None,
+    compact=None,
+    workers=None,
+    grid=None,
+    profile=None,
+    garbin_martz=None,
+):
+    """
+    Create the routing, bathymetry, soils and high resolution files
+    backend chooses the implementation of the routing stages (see get_backend)
+    compact the encodings used while routing, grid can reuse the grid values and
+    garbin_martz adds the gradient away from higher terrain on flats (see _calculate_routing)
+    With the previous routing dataset only the edited basins are routed again (see update_routing)
+    unless all the stages are in the stage cache, a full run is done when the update fails
+    The bathymetry, soils and high resolution files are built by worker threads at the same time
+    (by default the ROUTING_WORKERS environment variable or one after the other)
+    Give a RoutingProfile as profile to measure each stage
+    """
+    ds_routing = None
+    if previous is not None:
+        # Loading the cached stages is faster than updating the routing
+        try:
+            ds_routing = _calculate_routing(
+                topo,
+                latitudes,
+                backend,
+                compact,
+                grid,
+                profile,
+                cached_only=True,
+                garbin_martz=garbin_martz,
+            )
+        except CacheMissError:
+            pass
+    if previous is not None and ds_routing is None:
+        print(
+            f" [c] {datetime.now()} Updating routing of the edited basins", flush=True
+        )
+        with _measure(profile, "update_routing") as details:
+            try:
+                ds_routing = update_routing(
+                    previous, topo, latitudes, changed, backend, garbin_martz
+                )
+            except Exception as error:
+                # The full run is always possible, the update is only faster
+                print(
+                    f" [c] {datetime.now()} Updating the routing failed: {error!r}",
+                    flush=True,
+                )
+            details["updated"] = ds_routing is not None
+        if ds_routing is None:
+            print(f" [c] {datetime.now()} Can not update the routing", flush=True)
+    if ds_routing is None:
+        ds_routing = _calculate_routing(
+            topo, latitudes, backend, compact, grid, profile, garbin_martz=garbin_martz
+        )
+    topo = ds_routing.topo.values[::-1]
+    omsk = get_stage("calculate_omsk", backend)(topo)
+    rlon, rlat = ds_routing.nav_lon.values, ds_routing.nav_lat.values
+
+    # The builders only read the routing results so they can run at the same time
+    if workers is None:
+        workers = int(os.environ.get("ROUTING_WORKERS", 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        print(f" [c] {datetime.now()} Creating Bathy file", flush=True)
+        ds_bathy = executor.submit(
+            _run_measured, profile, create_bathy_paleo_orca, topo, custom_orca
+        )
+        print(f" [c] {datetime.now()} Creating Soils file", flush=True)
+        ds_soils = executor.submit(
+            _run_measured, profile, create_soils, rlat, rlon, omsk
+        )
+        print(f" [c] {datetime.now()} Creating High Res file", flush=True)
+        ds_topo_high_res = executor.submit(
+            _run_measured, profile, create_topo_high_res, topo
+        )
+
+    return ds_routing, ds_bathy.result(), ds_soils.result(), ds_topo_high_res.result()
+
+
+def run_routines_batch(
+    topos,
+    latitudes,
+    custom_orca=None,
+    backend=None,
+    compact=None,
+    workers=None,
+    profile=None,
+    garbin_martz=None,
+):
+    """
+    Create the files of run_routines for a stack of topographies on the same grid (first dimension)
+    The grid coordinates and areas are calculated once and the ORCA remapping index and
+    packaged files are loaded once. Returns the routing, bathymetry, soils and high resolution
+    datasets with the values of all the topographies along a new member dimension
+    """
+    if compact is None:
+        compact = _use_compact()
+    grid = _calculate_grid(topos.shape[1:], backend, compact, profile)
+    results = []
+    for i, topo in enumerate(topos):
+        print(
+            f" [c] {datetime.now()} Routing member {i + 1} / {len(topos)}", flush=True
+        )
+        results.append(
+            run_routines(
+                topo,
+                latitudes,
+                custom_orca,
+                backend,
+                compact=compact,
+                workers=workers,
+                grid=grid,
+                profile=profile,
+                garbin_martz=garbin_martz,
+            )
+        )
+    # The coordinates are the same for all the members (soils has them as variables)
+    return tuple(
+        xr.concat(
+            datasets,
+            dim="member",
+            data_vars=[
+                name
+                for name in datasets[0].data_vars
+                if name not in ("nav_lon", "nav_lat")
+            ],
+            coords="minimal",
+            compat="override",
+            # The routing checksums of the members are different so they are dropped
+            combine_attrs="drop_conflicts",
+        )
+        for datasets in zip(*results)
+    )
@@ -0,0 +1,36 @@
+import numpy
+
+
+def relabel(labels, lut):
+    """
+    Replace every label by its value in the lookup table, lut[label] is the new label
+    This is a single pass over the array however many labels are changed
+    """
+    return numpy.asarray(lut)[labels]
+
+
+def merge_dateline_labels(labels):
+    """
+    Merge the labels of features crossing the dateline (first and last columns touch)
+    0 is the background, connected labels are all replaced by the smallest one
+    """
+    left, right = labels[:, 0], labels[:, -1]
+    pairs = (left != right) & (left != 0) & (right != 0)
+
+    # Union find over the labels seen on the edges, the root of a group is its smallest label
+    parents = numpy.arange(labels.max() + 1)
+
+    def find(label):
+        while parents[label] != label:
+            parents[label] = parents[parents[label]]
+            label = parents[label]
+        return label
+
+    for a, b in zip(left[pairs], right[pairs]):
+        a, b = find(a), find(b)
+        parents[max(a, b)] = min(a, b)
+
+    # Point every label straight to the root of its group
+    while numpy.any(parents[parents] != parents):
+        parents = parents[parents]
+    return relabel(labels, parents)
@@ -1,19 +1,29 @@
 from datetime import datetime
 import numpy
 import json
+import os
+import tempfile
 
 from climate_simulation_platform import create_app
 from climate_simulation_platform.db import (
+    get_file_path,
     get_lon_lat_names,
     load_file,
+    save_file_to_db,
     save_revision,
     step_seen,
     invalidate_step,
 )
-from climpy.bc.ipsl.routing import run_routines
+from climpy.bc.ipsl.routing import (
+    RoutingProfile,
+    create_basin_summary,
+    get_cache_key,
+    run_routines,
+    run_routines_batch,
+)
 from climpy.bc.ipsl.heatflow import create_heatflow
 from climpy.bc.ipsl.ahmcoef import create_ahmcoef
-from climpy.bc.ipsl.pft import generate_pft_netcdf
+from climpy.bc.ipsl.pft import generate_pft_netcdf, update_pft_netcdf
 
 
 def regrid(body):
@@ -82,22 +92,104 @@ def routing(body):
     with app.app_context():
         ds = load_file(_id, "raw")
         ds_orca = load_file(_id, "paleorca")
+        # With ROUTING_UPDATE only the basins changed since the last routing are routed
+        # again, it is off by default as the full run is about as fast on common grids
+        ds_previous = None
+        if os.environ.get("ROUTING_UPDATE", "").lower() in ("1", "true", "yes"):
+            ds_previous = load_file(_id, "routing")
         lon, lat = get_lon_lat_names(_id)
 
     latitudes = ds[lat].values
     topography = ds[topo_variable].values
+    # The time and memory of each stage are logged as JSON lines
+    # With ROUTING_PROFILE the allocations are traced too which slows the routing down
+    profiling = os.environ.get("ROUTING_PROFILE", "").lower() in ("1", "true", "yes")
+    profile = RoutingProfile(
+        trace_memory=profiling, id=_id, shape=list(topography.shape)
+    )
     ds_routing, ds_bathy, ds_soils, ds_topo_high_res = run_routines(
-        topography, latitudes, ds_orca
+        topography, latitudes, ds_orca, previous=ds_previous, profile=profile
     )
+    to_save = [
+        (ds, file_type)
+        for ds, file_type, save in (
+            (ds_routing, "routing", save_routing),
+            (ds_bathy, "bathy", save_bathy),
+            (ds_soils, "soils", save_soils),
+            (ds_topo_high_res, "topo_high_res", save_topo_high_res),
+        )
+        if save
+    ]
+    info = {}
+    # The stage measurements can also be saved in the routing revision info
+    if profiling:
+        info["routing"] = {"profile": profile.summary()}
+    save_revisions(app, _id, to_save, info)
+
+    # The basin table is saved as a csv file so it is only downloaded, never shown on a map
+    if save_routing:
+        basins_name = next(tempfile._get_candidate_names()) + ".csv"
+        create_basin_summary(ds_routing).to_dataframe().to_csv(
+            os.path.join(app.config["UPLOAD_FOLDER"], basins_name)
+        )
+        with app.app_context():
+            save_file_to_db(_id, basins_name, "routing_basins")
+
+
+def routing_batch(body):
+    app = create_app()
+
+    topo_variable = body["topo_var"]
+    _id = body["id"]
+
+    # Load file
+    with app.app_context():
+        ds = load_file(_id, "raw")
+        ds_orca = load_file(_id, "paleorca")
+        lon, lat = get_lon_lat_names(_id)
+
+    latitudes = ds[lat].values
+    # Every other dimension of the topography variable is a member of the batch
+    topographies = ds[topo_variable]
+    batch_dims = [dim for dim in topographies.dims if dim not in (lat, lon)]
+    if not batch_dims:
+        raise ValueError(
+            f"{topo_variable} has no dimension other than {lat} and {lon} to batch over"
+        )
+    topographies = topographies.stack(member=batch_dims).transpose("member", lat, lon)
+    results = run_routines_batch(topographies.values, latitudes, ds_orca)
+    # Put the members back on the dimensions and coordinates of the uploaded file
+    # Unstacking can sort the coordinates so they are selected in their original order
+    coords = {dim: ds[dim] for dim in batch_dims if dim in ds.coords}
+    results = [
+        result.assign_coords(member=topographies.member)
+        .unstack("member")
+        .drop_vars([dim for dim in batch_dims if dim not in coords])
+        .sel({dim: coord.values for dim, coord in coords.items()})
+        .assign_coords(coords)
+        .transpose(*batch_dims, ...)
+        for result in results
+    ]
+    save_revisions(
+        app,
+        _id,
+        list(
+            zip(
+                results,
+                ["routing_batch", "bathy_batch", "soils_batch", "topo_high_res_batch"],
+            )
+        ),
+    )
+
+
+def save_revisions(app, _id, to_save, info=None):
+    # The files are written one after the other, xarray writes one netCDF file at a time anyway
+    # info has the revision info of the file types
+    if info is None:
+        info = {}
     with app.app_context():
-        if save_routing:
-            save_revision(_id, ds_routing, "routing")
-        if save_bathy:
-            save_revision(_id, ds_bathy, "bathy")
-        if save_soils:
-            save_revision(_id, ds_soils, "soils")
-        if save_topo_high_res:
-            save_revision(_id, ds_topo_high_res, "topo_high_res")
+        for ds, file_type in to_save:
+            save_revision(_id, ds, file_type, info.get(file_type, {}))
 
 
 def pft(body):
@@ -119,16 +211,52 @@ def pft(body):
     # Load routing file with final topography
     with app.app_context():
         ds = load_file(_id, "routing")
+        previous_path = get_file_path(_id, "pft")
     assert set(ds.dims) == set(("x", "y"))
     assert len(ds.coords) == 2
-    # The PFT values are on a 360 x 720 grid
+    # The PFT values are on a grid with the chosen resolution (by default 0.5 degrees)
     # So we need to interpolate the values onto this grid
-    lat_vals = numpy.arange(0, 180, 0.5)
-    lon_vals = numpy.arange(0, 360, 0.5)
+    resolution = float(body.get("resolution", 0.5))
+    if not 0 < resolution <= 180:
+        raise ValueError(
+            f"The PFT resolution should be above 0 and at most 180, got {resolution}"
+        )
+    nb_lat, nb_lon = int(round(180 / resolution)), int(round(360 / resolution))
+    # The file has 13 values per cell, PFT_MAX_CELLS (by default a 0.1 degree grid) keeps it in memory
+    max_cells = int(os.environ.get("PFT_MAX_CELLS", 1800 * 3600))
+    if nb_lat * nb_lon > max_cells:
+        raise ValueError(
+            f"A {resolution} degree PFT grid has {nb_lat * nb_lon} cells, "
+            f"the maximum is {max_cells} (PFT_MAX_CELLS), use a coarser resolution"
+        )
+    # The PFT_STORAGE environment variable chooses how the values are stored
+    storage = os.environ.get("PFT_STORAGE", "float32")
+    topo_checksum = get_cache_key(ds.topo.values)
+
+    # When the topography hasn't changed only the rows of the edited latitude bands
+    # are written again in a copy of the last file
+    if previous_path is not None:
+        temp_name = next(tempfile._get_candidate_names()) + ".nc"
+        if update_pft_netcdf(
+            previous_path,
+            os.path.join(app.config["UPLOAD_FOLDER"], temp_name),
+            (nb_lat, nb_lon),
+            latitudes,
+            pft_values,
+            storage,
+            topo_checksum,
+        ):
+            with app.app_context():
+                save_file_to_db(_id, temp_name, "pft")
+            return
+
+    lat_vals = numpy.arange(nb_lat) * ds.sizes["y"] / nb_lat
+    lon_vals = numpy.arange(nb_lon) * ds.sizes["x"] / nb_lon
     ds = ds.interp({"y": lat_vals, "x": lon_vals})
     topo = ds.topo.values
 
-    ds = generate_pft_netcdf(topo, latitudes, pft_values)
+    ds = generate_pft_netcdf(topo, latitudes, pft_values, storage)
+    ds.attrs["topo_checksum"] = topo_checksum
     with app.app_context():
         save_revision(_id, ds, "pft")
 
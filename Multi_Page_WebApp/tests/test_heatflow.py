@@ -0,0 +1,96 @@
+from climpy.bc.ipsl import heatflow
+
+import numpy
+from scipy.ndimage import median_filter
+import xarray as xr
+
+import pytest
+
+
+def test_create_heatflow():
+    bathy = numpy.zeros((20, 30))
+    # Margins, deep ocean and a very deep trench
+    bathy[:, 10:20] = 1000
+    bathy[:, 20:] = 4000
+    bathy[5:8, 25:28] = 6000
+    ds_bathy = xr.Dataset(
+        {"Bathymetry": (["y", "x"], bathy)},
+        coords={
+            "nav_lon": (["y", "x"], numpy.tile(numpy.arange(30.0), (20, 1))),
+            "nav_lat": (["y", "x"], numpy.tile(numpy.arange(20.0)[:, None], (1, 30))),
+        },
+    )
+    ds = heatflow.create_heatflow(ds_bathy)
+    assert ds.heatflow.dims == ("time_counter", "y", "x")
+    values = ds.heatflow.values[0]
+    # No heat on land
+    assert numpy.all(values[:, :10] == 0)
+    # Constant heat on the margins away from the slopes
+    assert numpy.all(values[:, 12:18] == 48)
+    # Heat of the sea floor age
+    age = ((4000 - 2600.0) / 365) ** 2
+    assert numpy.allclose(values[10:, 22:], 490 / age**0.5)
+    assert numpy.all(values >= 0)
+    assert numpy.all(values <= 400)
+
+
+def previous_heatflow(bathy):
+    # The xarray implementation replaced by heatflow._calculate_heatflow
+    sfage0 = ((bathy - 2600.0) / 365) ** 2
+    sfage20 = (-1 / 0.0278) * numpy.log((bathy - 5651.0) / (-2473))
+    masksf0 = xr.where(sfage0 > 20, 0, 1)
+    masksf20 = xr.where(sfage20 >= 20, 1, 0)
+    sfage = sfage0 * masksf0 + sfage20 * masksf20
+    maskdepth = xr.where(bathy > 2500, 1, 0)
+    heat0m = 490 / (sfage**0.5) * maskdepth
+    heat0oc = xr.where(heat0m > 400, 400, heat0m)
+    heat0ma = xr.where((bathy > 0) & (bathy < 2500), 48, 0)
+    heat = xr.where(heat0oc > 0, heat0oc, 0) + xr.where(heat0ma > 0, heat0ma, 0)
+
+    def xgradient(x):
+        return numpy.abs(numpy.gradient(numpy.gradient(x, axis=0), axis=1))
+
+    gradxbathy = xr.apply_ufunc(xgradient, bathy)
+    maskgrad = xr.where((gradxbathy > 500) & (heat > 100), 0, 1)
+    void_heat = xr.where(heat * maskgrad > 0, heat * maskgrad, 0)
+    vals = void_heat.values
+    mask_void = xr.where(void_heat.isnull() & (bathy > 0), 1, 0)
+    for _ in range(2):
+        vals = numpy.where(mask_void == 1, median_filter(vals, (3, 3)), vals)
+    return vals * xr.where(bathy > 0, 1, 0).values
+
+
+@pytest.mark.parametrize("dtype", (numpy.float64, numpy.float32))
+def test_calculate_heatflow_parity(dtype):
+    # Land, margins, deep ocean on both sides of the sea floor age switch and steep slopes
+    bathy = numpy.random.default_rng(0).uniform(-500, 6500, (24, 36)).astype(dtype)
+    bathy[:4] = numpy.nan
+    bathy[4:8] = 0
+    bathy[8:12, ::2] = 3000
+    bathy[8:12, 1::2] = 4500
+    expected = previous_heatflow(xr.DataArray(bathy, dims=["y", "x"]))
+    numpy.testing.assert_allclose(
+        heatflow._calculate_heatflow(bathy), expected, rtol=1e-6
+    )
+
+
+def test_fill_xy():
+    values = numpy.random.default_rng(0).random((20, 30))
+    mask = numpy.zeros(values.shape, dtype=bool)
+    mask[::4, ::5] = True
+    # Each masked cell takes the median of its window
+    expected = numpy.where(mask, median_filter(values, (3, 3)), values)
+    numpy.testing.assert_array_equal(heatflow._fill_xy(values, mask, 1), expected)
+
+    # The center of a 3 x 3 void has no values around it until the second pass
+    values[4:7, 4:7] = numpy.nan
+    mask = numpy.isnan(values)
+    filled = heatflow._fill_xy(values, mask, 1)
+    assert numpy.isnan(filled[5, 5])
+    assert numpy.sum(numpy.isnan(filled)) == 1
+    filled = heatflow._fill_xy(values, mask, 2)
+    assert not numpy.any(numpy.isnan(filled))
+    # Its neighbors were filled by the first pass
+    neighbors = numpy.delete(filled[4:7, 4:7].flatten(), 4)
+    assert filled[5, 5] == numpy.median(neighbors)
+    numpy.testing.assert_array_equal(filled[~mask], values[~mask])
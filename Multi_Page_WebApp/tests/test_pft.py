@@ -3,6 +3,8 @@ from climpy.bc.ipsl import pft
 import xarray as xr
 import numpy
 
+import pytest
+
 ds_input = xr.open_dataset("./tests/data/input.nc")
 
 
@@ -39,3 +41,114 @@ def test_generate_pft_netcdf():
     # Make sure values are between 0 and 1
     assert numpy.nanmax(results) <= 1
     assert numpy.nanmin(results) >= 0
+
+
+def test_generate_pft_netcdf_bands():
+    topo = numpy.ones((360, 720))
+    topo[:, :10] = -1
+    latitudes = [30, 60, 90]
+    pft_values = numpy.zeros((3, 13))
+    pft_values[:, 0] = [100, 50, 20]
+
+    results = pft.generate_pft_netcdf(topo, latitudes, pft_values).maxvegetfrac
+    bare_ground = results.values[0, 0, :, 10]
+    # Rows go from North to South and each band is set in both hemispheres
+    numpy.testing.assert_array_equal(bare_ground, bare_ground[::-1])
+    numpy.testing.assert_array_equal(bare_ground[:60], 0.2)
+    numpy.testing.assert_array_equal(bare_ground[60:120], 0.5)
+    numpy.testing.assert_array_equal(bare_ground[120:180], 1)
+    assert numpy.all(numpy.isnan(results.values[0, :, :, :10]))
+    assert numpy.all(results.values[0, 1:, :, 10:] == 0)
+
+
+def test_generate_pft_netcdf_resolution():
+    # The input file is on a 1 degree grid
+    topo = ds_input.topo.values[::-1]
+    latitudes = [30, 60, 90]
+    pft_values = numpy.zeros((3, 13))
+    pft_values[:, 0] = [100, 50, 20]
+
+    ds = pft.generate_pft_netcdf(topo, latitudes, pft_values)
+    assert ds.maxvegetfrac.shape == (1, 13, 180, 360)
+    numpy.testing.assert_array_equal(ds.lat, numpy.arange(89.5, -90, -1))
+    numpy.testing.assert_array_equal(ds.lon, numpy.arange(-179.5, 180, 1))
+    bare_ground = ds.maxvegetfrac.values[0, 0]
+    assert numpy.all(numpy.isnan(bare_ground[topo <= 0]))
+    numpy.testing.assert_array_equal(
+        bare_ground[:30][topo[:30] > 0], numpy.float32(0.2)
+    )
+
+
+@pytest.mark.parametrize("storage", ["float64", "float32", "int8"])
+def test_generate_pft_netcdf_storage(tmp_path, storage):
+    topo = numpy.ones((360, 720))
+    topo[:, :10] = -1
+    latitudes = [15, 35, 50, 80, 90]
+    pft_values = numpy.random.default_rng(0).integers(0, 101, (5, 13))
+
+    ds = pft.generate_pft_netcdf(topo, latitudes, pft_values, storage)
+    ds.to_netcdf(tmp_path / "pft.nc", format="NETCDF3_64BIT")
+    expected = pft.generate_pft_netcdf(topo, latitudes, pft_values, "float64")
+    with xr.open_dataset(tmp_path / "pft.nc", decode_times=False) as saved:
+        numpy.testing.assert_allclose(
+            saved.maxvegetfrac, expected.maxvegetfrac, rtol=1e-6
+        )
+
+
+def test_generate_pft_netcdf_unknown_storage():
+    with pytest.raises(ValueError):
+        pft.generate_pft_netcdf(
+            numpy.ones((360, 720)), [90], numpy.ones((1, 13)) * 50, "uint8"
+        )
+
+
+@pytest.mark.parametrize("storage", ["float64", "float32", "int8"])
+def test_update_pft_netcdf(tmp_path, storage):
+    topo = ds_input.topo.values[::-1]
+    latitudes = [15, 35, 50, 80, 90]
+    pft_values = numpy.random.default_rng(0).integers(0, 50, (5, 13))
+    ds = pft.generate_pft_netcdf(topo, latitudes, pft_values, storage)
+    ds.attrs["topo_checksum"] = "topo"
+    ds.to_netcdf(tmp_path / "previous.nc", format="NETCDF3_64BIT")
+
+    # Edit one band and move a cutoff latitude
+    new_latitudes = [15, 40, 50, 80, 90]
+    new_values = pft_values.copy()
+    new_values[3, 2] += 10
+    assert pft.update_pft_netcdf(
+        tmp_path / "previous.nc",
+        tmp_path / "pft.nc",
+        topo.shape,
+        new_latitudes,
+        new_values,
+        storage,
+        "topo",
+    )
+    expected = pft.generate_pft_netcdf(topo, new_latitudes, new_values, storage)
+    expected.to_netcdf(tmp_path / "expected.nc", format="NETCDF3_64BIT")
+    with xr.open_dataset(tmp_path / "pft.nc", decode_times=False) as result:
+        with xr.open_dataset(tmp_path / "expected.nc", decode_times=False) as e:
+            xr.testing.assert_identical(result.maxvegetfrac, e.maxvegetfrac)
+        numpy.testing.assert_array_equal(result.attrs["pft_latitudes"], new_latitudes)
+        # The next edit is compared with the new table
+        numpy.testing.assert_array_equal(
+            result.attrs["pft_values"], new_values.flatten()
+        )
+
+    # The file is generated again for another topography, grid or storage
+    for arguments in (
+        (topo.shape, latitudes, pft_values, storage, "other"),
+        (topo.shape, latitudes, pft_values, storage, None),
+        ((360, 720), latitudes, pft_values, storage, "topo"),
+        (
+            topo.shape,
+            latitudes,
+            pft_values,
+            "int8" if storage != "int8" else "float32",
+            "topo",
+        ),
+    ):
+        assert not pft.update_pft_netcdf(
+            tmp_path / "previous.nc", tmp_path / "other.nc", *arguments
+        )
+    assert not (tmp_path / "other.nc").exists()
@@ -1,6 +1,10 @@
-from climpy.bc.ipsl import routing
+from climpy import labels
+from climpy.bc.ipsl import assets, routing, routing_reference
 
+import json
+import os
 import numpy
+import tracemalloc
 import xarray as xr
 
 import pytest
@@ -130,6 +134,100 @@ def test_get_padded_array(arr, ensure_gradient, res):
     assert numpy.all(padded == res)
 
 
+def test_fill_depressions_in_topo():
+    # A depression on the date line surrounded by higher terrain
+    topo = numpy.full((10, 20), 10.0)
+    topo[:, 8:12] = -100
+    topo[4:6, [0, -1]] = 2.0
+    filled = routing._fill_depressions_in_topo(topo)
+    assert numpy.all(filled[4:6, [0, -1]] == 10.0)
+    # The ocean is not modified (apart from the Antartic row)
+    assert numpy.all(filled[1:][topo[1:] <= 0] == topo[1:][topo[1:] <= 0])
+
+    # Filling does not depend on where the date line is
+    topo = routing._ensure_south_up(ds_input.topo.values, ds_input.lat.values)
+    filled = routing._fill_depressions_in_topo(topo)
+    rolled = routing._fill_depressions_in_topo(numpy.roll(topo, 100, axis=1))
+    assert numpy.all(numpy.roll(filled, 100, axis=1) == rolled)
+
+
+@pytest.mark.parametrize("garbin_martz", (False, True))
+def test_add_gradient_to_flats(garbin_martz):
+    # A flat plateau surrounded by higher terrain with a single exit point
+    topo = numpy.full((20, 30), 10.0)
+    topo[3:17, 3:27] = 5.0
+    topo[10, 2] = 1.0
+    flat = topo == 5.0
+    topo = routing._add_gradient_to_flats(topo, garbin_martz=garbin_martz)
+    differences = routing.get_differences_with_neighbors(topo, ensure_gradient=True)
+    # Water can now flow downwards from every cell of the flat
+    assert numpy.all(numpy.max(differences, axis=0)[flat] > 0)
+    # The flat is still lower than the surroundings
+    assert numpy.all(topo[flat] < 6)
+
+
+def test_get_downstream_indices():
+    trip = numpy.array(
+        [
+            [numpy.nan, numpy.nan, numpy.nan],
+            [7, 3, 5],
+            [5, 5, 5],
+        ]
+    )
+    downstream = routing.get_downstream_indices(trip)
+    # Ocean cells and cells flowing into the ocean point to -1
+    # Cell (1, 0) flows West and wraps around to (1, 2)
+    assert numpy.all(downstream == numpy.array([-1, -1, -1, 5, 5, -1, 3, 4, 5]))
+
+
+def test_get_next_cell_long_river():
+    # A river longer than the recursion limit flowing East then into the ocean
+    trip = numpy.full((3, 5000), numpy.nan)
+    trip[1] = 3
+    trip[1, -1] = 1
+    cells, end_reason, next_cell = routing_reference.get_next_cell(
+        [(1, 0)], numpy.zeros(trip.shape), trip
+    )
+    assert cells == [(1, j) for j in range(5000)]
+    assert end_reason == "ocean"
+    assert next_cell == (2, 4999)
+
+    # A loop between two cells
+    trip[1, 10:12] = [3, 7]
+    cells, end_reason, next_cell = routing_reference.get_next_cell(
+        [(1, 0)], numpy.zeros(trip.shape), trip
+    )
+    assert cells == [(1, j) for j in range(12)]
+    assert end_reason == "infinite_loop"
+    assert next_cell == (1, 10)
+
+
+def test_get_upstream_levels():
+    downstream = numpy.array([-1, -1, -1, 5, 5, -1, 3, 4, 5])
+    levels = routing.get_upstream_levels(downstream)
+    assert len(levels) == 3
+    assert set(levels[0]) == set((0, 1, 2, 5))
+    assert set(levels[1]) == set((3, 4, 8))
+    assert set(levels[2]) == set((6, 7))
+
+
+def test_calculate_outflow_points():
+    trip = numpy.array(
+        [
+            [numpy.nan, numpy.nan, numpy.nan],
+            [7, 3, 5],
+            [5, 5, 5],
+        ]
+    )
+    basins = numpy.where(numpy.isnan(trip), numpy.nan, 1)
+    outflow_points = routing.calculate_outflow_points(basins, trip)
+    assert numpy.all(outflow_points == numpy.array([[1, 2]]))
+
+    basins[2] = 2
+    with pytest.raises(AssertionError, match="No outflow points for basin 2"):
+        routing.calculate_outflow_points(basins, trip)
+
+
 def test_cmsk():
     topo, latitudes = ds_input.topo.values, ds_input.lat.values
     topo = routing.fix_topo(topo, latitudes)
@@ -281,6 +379,164 @@ def test_run_routines():
     assert_ds_routing(ds_routing)
 
 
+def test_run_routines_workers():
+    # The output files are the same when they are built at the same time
+    topo = ds_runoff.topo.values
+    latitudes = ds_runoff.lat.values
+    expected = routing.run_routines(topo, latitudes, workers=1)
+    results = routing.run_routines(topo, latitudes, workers=3)
+    for e, r in zip(expected, results):
+        xr.testing.assert_identical(r, e)
+
+
+def test_run_routines_profile(capsys):
+    topo = ds_runoff.topo.values
+    latitudes = ds_runoff.lat.values
+    profile = routing.RoutingProfile(id=1)
+    routing.run_routines(topo, latitudes, profile=profile)
+    names = [details["stage"] for details in profile.stages]
+    assert set(routing.stages) <= set(names)
+    assert {
+        "create_routing_netcdf",
+        "create_bathy_paleo_orca",
+        "create_soils",
+        "create_topo_high_res",
+    } <= set(names)
+    for details in profile.stages:
+        assert details["wall_time"] >= 0
+        assert details["cpu_time"] >= 0
+        assert details["process_peak_rss_increase"] >= 0
+        assert "peak_allocated" not in details
+    assert len(profile.summary().split("\n")) == len(names)
+    assert profile.to_dict()["id"] == 1
+    # Each stage is printed as a JSON line with the context
+    lines = [
+        json.loads(line)["routing_profile"]
+        for line in capsys.readouterr().out.split("\n")
+        if line.startswith('{"routing_profile"')
+    ]
+    assert [details["stage"] for details in lines] == names
+    assert all(details["id"] == 1 for details in lines)
+
+
+def test_routing_profile_trace_memory():
+    profile = routing.RoutingProfile(log=False, trace_memory=True)
+    with profile.measure("allocate"):
+        kept = [numpy.ones(2**20) for _ in range(3)]
+        numpy.ones(2**22)
+    with profile.measure("nothing"):
+        pass
+    # tracemalloc is only tracing while the stages are measured
+    assert not tracemalloc.is_tracing()
+    allocate, nothing = profile.stages
+    assert allocate["peak_allocated"] >= 3 * kept[0].nbytes + 2**22 * 8
+    assert 3 * kept[0].nbytes <= allocate["allocated"] < 2**22 * 8
+    assert allocate["allocated_blocks"] >= 3
+    assert nothing["peak_allocated"] < 2**20
+    assert "peak allocated" in profile.summary()
+
+    # Stages measured at the same time share the tracing
+    with profile.measure("outer"):
+        with profile.measure("inner"):
+            assert tracemalloc.is_tracing()
+        assert tracemalloc.is_tracing()
+    assert not tracemalloc.is_tracing()
+
+
+def test_run_routines_batch():
+    topo = ds_runoff.topo.values
+    latitudes = ds_runoff.lat.values
+    topos = numpy.stack([topo, numpy.where(topo > 0, topo * 1.5, topo)])
+    results = routing.run_routines_batch(topos, latitudes)
+    for i in range(len(topos)):
+        expected = routing.run_routines(topos[i], latitudes)
+        for ds, e in zip(results, expected):
+            assert ds.sizes["member"] == len(topos)
+            for name in e.variables:
+                value = ds[name]
+                if "member" in value.dims:
+                    value = value.isel(member=i)
+                numpy.testing.assert_array_equal(value.values, e[name].values)
+
+
+def test_run_routines_garbin_martz(tmp_path, monkeypatch):
+    monkeypatch.setenv("ROUTING_CACHE_DIR", str(tmp_path))
+    topo = ds_runoff.topo.values
+    latitudes = ds_runoff.lat.values
+    options = []
+    add_gradient_to_flats = routing._add_gradient_to_flats
+
+    def record(topo, garbin_martz=False):
+        options.append(garbin_martz)
+        return add_gradient_to_flats(topo, garbin_martz)
+
+    monkeypatch.setattr(routing, "_add_gradient_to_flats", record)
+    ds_routing = routing.run_routines(topo, latitudes)[0]
+    # The option is read from the environment and is part of the stage cache key
+    monkeypatch.setenv("ROUTING_GARBIN_MARTZ", "1")
+    ds_garbin_martz = routing.run_routines(topo, latitudes)[0]
+    assert options == [False, True]
+    assert not numpy.array_equal(ds_routing.topo.values, ds_garbin_martz.topo.values)
+    # The argument wins over the environment and the cached results are loaded
+    xr.testing.assert_identical(
+        routing.run_routines(topo, latitudes, garbin_martz=False)[0], ds_routing
+    )
+    assert options == [False, True]
+
+    with pytest.raises(ValueError, match="Garbin and Martz"):
+        routing.run_routines(topo, latitudes, backend={"fix_topo": "reference"})
+
+
+def test_basin_summary():
+    topo = ds_runoff.topo.values
+    latitudes = ds_runoff.lat.values
+    ds_routing = routing.run_routines(topo, latitudes)[0]
+    # The routing file only has variables on the map
+    assert set(ds_routing.dims) == {"x", "y"}
+    ds_basins = routing.create_basin_summary(ds_routing)
+    basins = ds_routing.basins.values
+    area = routing.calculate_area(ds_routing.nav_lat.values)
+    assert ds_basins.sizes["basin"] == numpy.nanmax(basins)
+    # Compare with the values calculated with a mask for each basin
+    for i in range(100):
+        in_basin = basins == ds_basins.basin.values[i]
+        assert ds_basins.cells[i] == in_basin.sum()
+        assert numpy.isclose(ds_basins.area[i], area[in_basin].sum())
+        height = ds_routing.topo.values[in_basin].mean()
+        assert numpy.isclose(ds_basins.height[i], height)
+        y, x = ds_basins.outlet_y.values[i], ds_basins.outlet_x.values[i]
+        assert in_basin[y, x]
+        assert ds_routing.trip.values[y, x] == ds_basins.outflow[i]
+        assert numpy.sum(ds_routing.trip.values[in_basin] > 50) == 1
+
+
+def test_merge_dateline_labels():
+    # 1 and 3 touch across the dateline and 3 touches 2 so all three are merged
+    arr = numpy.array(
+        [
+            [1, 0, 0, 3],
+            [0, 0, 0, 0],
+            [2, 0, 0, 3],
+            [0, 0, 4, 0],
+            [5, 0, 0, 0],
+        ]
+    )
+    res = numpy.array(
+        [
+            [1, 0, 0, 1],
+            [0, 0, 0, 0],
+            [1, 0, 0, 1],
+            [0, 0, 4, 0],
+            [5, 0, 0, 0],
+        ]
+    )
+    numpy.testing.assert_array_equal(labels.merge_dateline_labels(arr), res)
+    numpy.testing.assert_array_equal(
+        labels.relabel(arr, [0, 2, 2, 2, 1, 3]),
+        [[2, 0, 0, 2], [0] * 4, [2, 0, 0, 2], [0, 0, 1, 0], [3, 0, 0, 0]],
+    )
+
+
 def test_create_orca_dataset():
     topo = ds_runoff.topo.values
 
@@ -294,6 +550,56 @@ def test_create_orca_dataset():
     assert ds.Bathymetry.shape == (149, 182)
 
 
+def test_load_asset():
+    assets.clear_assets()
+    ds_orca = assets.load_asset("paleorca2_40Ma_grid.nc")
+    assert ds_orca.lat.shape == (149, 182)
+    # The files are only read once and the shared values can't be changed
+    again = assets.load_asset("paleorca2_40Ma_grid.nc")
+    assert again.lat.values is ds_orca.lat.values
+    with pytest.raises(ValueError):
+        ds_orca.lat.values[0, 0] = 0
+    del ds_orca.lat.encoding["missing_value"]
+    assert "missing_value" in again.lat.encoding
+    lat_vals = assets.load_asset("topo_high_res_y_vals.npy")
+    assert not lat_vals.flags.writeable
+    with pytest.raises(ValueError):
+        assets.load_asset("unknown.nc")
+
+
+def test_get_remap_index(tmp_path, monkeypatch):
+    monkeypatch.setenv("ROUTING_CACHE_DIR", str(tmp_path))
+    routing._remap_indexes.clear()
+    ds_orca = xr.open_dataset(
+        "./python_tools/climpy/bc/ipsl/paleorca2_40Ma_grid.nc"
+    ).load()
+    # Missing coordinates are not remapped
+    ds_orca.lat[0, 0] = numpy.nan
+    values = numpy.random.rand(90, 180)
+    lat, lon = routing._get_coordinates(values.shape)
+    expected = xr.DataArray(values, coords={"lat": lat, "lon": lon}).interp(
+        ds_orca.coords, method="nearest", kwargs={"fill_value": None}
+    )
+
+    index = routing.get_remap_index(values.shape, ds_orca)
+    assert index.dims == expected.dims
+    assert index.values[0, 0] == -1
+    result = numpy.where(index >= 0, values.flatten()[index], numpy.nan)
+    numpy.testing.assert_array_equal(result, expected.values)
+
+    # The index is loaded from the cache directory
+    assert len(list(tmp_path.iterdir())) == 1
+    routing._remap_indexes.clear()
+    xr.testing.assert_identical(routing.get_remap_index(values.shape, ds_orca), index)
+
+    # Another version of the code calculates the index again
+    monkeypatch.setattr(routing, "cache_version", routing.cache_version + 1)
+    monkeypatch.setattr(routing, "_code_keys", {})
+    routing._remap_indexes.clear()
+    xr.testing.assert_identical(routing.get_remap_index(values.shape, ds_orca), index)
+    assert len(list(tmp_path.iterdir())) == 2
+
+
 def test_high_res_relief():
     topo = ds_runoff.topo.values
 
@@ -326,3 +632,331 @@ def test_soils():
 
     assert set(numpy.unique(ds.soilcolor)) == set((0, 4))
     assert set(numpy.unique(ds.soiltext)) == set((0, 3))
+
+
+@pytest.fixture(scope="module")
+def stage_values():
+    # Inputs of every routing stage calculated from the test data
+    values = {
+        "input_topo": ds_input.topo.values,
+        "latitudes": ds_input.lat.values,
+        "topo": ds_runoff.topo.values,
+        "trip": ds_runoff.rtm.values,
+    }
+    values["omsk"] = routing.calculate_omsk(values["topo"])
+    values["rlon"], values["rlat"] = routing.calculate_curvilinear_coordinates()
+    values["area"] = routing.calculate_area(values["rlat"])
+    values["basins"] = routing.calculate_basins(
+        values["topo"], values["trip"], values["area"]
+    )
+    values["ocean_distances"] = routing.calculate_ocean_distances(
+        values["trip"], values["rlat"]
+    )
+    values["river_length"] = routing.calculate_river_lengths(
+        values["topo"], values["trip"], values["ocean_distances"], values["omsk"]
+    )
+    values["distbox"] = routing.calculate_distbox(
+        values["river_length"], values["trip"]
+    )
+    values["outflow_points"] = routing.calculate_outflow_points(
+        values["basins"], values["trip"]
+    )
+    values["dzz"] = routing.calculate_dzz(
+        values["topo"], values["trip"], values["distbox"], values["omsk"]
+    )
+    return values
+
+
+stage_arguments = {
+    "fix_topo": ("input_topo", "latitudes"),
+    "calculate_orog": ("topo",),
+    "calculate_omsk": ("topo",),
+    "calculate_trip": ("topo", "omsk"),
+    "calculate_curvilinear_coordinates": (),
+    "calculate_area": ("rlat",),
+    "calculate_basins": ("topo", "trip", "area"),
+    "calculate_ocean_distances": ("trip", "rlat"),
+    "calculate_river_lengths": ("topo", "trip", "ocean_distances", "omsk"),
+    "calculate_distbox": ("river_length", "trip"),
+    "calculate_outflow_points": ("basins", "trip"),
+    "calculate_trip_outflow_values": (
+        "trip",
+        "outflow_points",
+        "basins",
+        "omsk",
+        "rlat",
+    ),
+    "calculate_dzz": ("topo", "trip", "distbox", "omsk"),
+    "calculate_topo_index": ("distbox", "dzz", "omsk"),
+}
+
+
+@pytest.mark.parametrize("backend", [b for b in routing.backends if b != "reference"])
+@pytest.mark.parametrize("stage", routing.stages)
+def test_backend_parity(stage_values, stage, backend):
+    # Every backend must give exactly the same results as the reference backend
+    arguments = [stage_values[name] for name in stage_arguments[stage]]
+    expected = routing.get_stage(stage, "reference")(*arguments)
+    result = routing.get_stage(stage, backend)(*arguments)
+    if not isinstance(expected, tuple):
+        expected, result = (expected,), (result,)
+    for e, r in zip(expected, result):
+        numpy.testing.assert_array_equal(r, e)
+
+
+compact_values = {
+    "omsk": "calculate_omsk",
+    "trip": "calculate_trip",
+    "basins": "calculate_basins",
+}
+
+
+@pytest.mark.parametrize("stage", routing.stages)
+def test_compact_stages(stage_values, stage):
+    # The stages give the same results with the compact encodings of their arguments
+    arguments = [stage_values[name] for name in stage_arguments[stage]]
+    compact = dict(stage_values)
+    for name, compact_stage in compact_values.items():
+        compact[name] = routing.to_compact(
+            compact[name], routing.compact_dtypes[compact_stage]
+        )
+    compact_arguments = [compact[name] for name in stage_arguments[stage]]
+    expected = routing.get_stage(stage)(*arguments)
+    result = routing.get_stage(stage)(*compact_arguments)
+    if stage in routing.compact_dtypes:
+        result = routing.to_compact(result, routing.compact_dtypes[stage])
+        assert result.dtype == routing.compact_dtypes[stage]
+        result = routing.to_legacy(result)
+    if not isinstance(expected, (tuple, list)):
+        expected, result = (expected,), (result,)
+    for e, r in zip(expected, result):
+        numpy.testing.assert_array_equal(r, e)
+
+
+def test_get_backend(monkeypatch):
+    monkeypatch.delenv("ROUTING_BACKEND", raising=False)
+    assert routing.get_backend("calculate_basins") == routing.default_backend
+    monkeypatch.setenv("ROUTING_BACKEND", "reference")
+    assert routing.get_backend("calculate_basins") == "reference"
+    monkeypatch.setenv("ROUTING_BACKEND_CALCULATE_BASINS", "vectorized")
+    assert routing.get_backend("calculate_basins") == "vectorized"
+    assert routing.get_backend("fix_topo") == "reference"
+    # The backend argument is used before the environment variables
+    assert routing.get_backend("fix_topo", {"fix_topo": "vectorized"}) == "vectorized"
+    assert routing.get_backend("calculate_basins", "reference") == "reference"
+    with pytest.raises(ValueError, match="Unknown routing backend"):
+        routing.get_backend("fix_topo", "unknown")
+    with pytest.raises(ValueError, match="Unknown routing stage"):
+        routing.get_stage("unknown")
+
+
+def test_run_cached_stage(tmp_path, monkeypatch):
+    monkeypatch.setenv("ROUTING_CACHE_DIR", str(tmp_path))
+    topo = ds_runoff.topo.values
+    topo_key = routing.get_cache_key(topo)
+    omsk, omsk_key = routing._run_cached_stage("calculate_omsk", None, (topo, topo_key))
+    assert len(list(tmp_path.glob("*.npz"))) == 1
+
+    def fail(*args):
+        raise AssertionError("Should be loaded from the cache")
+
+    # The second time the results are loaded from the cache
+    calculate_omsk = routing.calculate_omsk
+    monkeypatch.setattr(routing, "calculate_omsk", fail)
+    cached, cached_key = routing._run_cached_stage(
+        "calculate_omsk", None, (topo, topo_key)
+    )
+    assert cached_key == omsk_key
+    assert numpy.all(cached == omsk)
+    monkeypatch.setattr(routing, "calculate_omsk", calculate_omsk)
+
+    (rlon, rlat), keys = routing._run_cached_stage(
+        "calculate_curvilinear_coordinates", None
+    )
+    (cached_rlon, cached_rlat), cached_keys = routing._run_cached_stage(
+        "calculate_curvilinear_coordinates", None
+    )
+    assert keys == cached_keys and keys[0] != keys[1]
+    assert numpy.all(cached_rlon == rlon) and numpy.all(cached_rlat == rlat)
+
+    # Changing the backend or an input changes the key
+    assert (
+        routing._run_cached_stage("calculate_orog", "reference", (topo, topo_key))[1]
+        != routing._run_cached_stage("calculate_orog", None, (topo, topo_key))[1]
+    )
+    assert routing.get_cache_key(topo + 1) != topo_key
+
+    # The least recently used results are removed
+    monkeypatch.setenv("ROUTING_CACHE_DIR", str(tmp_path / "lru"))
+    monkeypatch.setenv("ROUTING_CACHE_SIZE", str(2.5 * omsk.nbytes / 1024**2))
+    _, orog_key = routing._run_cached_stage("calculate_orog", None, (topo, topo_key))
+    routing._run_cached_stage("calculate_omsk", None, (topo, topo_key))
+    # Files written in the same clock tick have the same modification time
+    for path in (tmp_path / "lru").glob("*.npz"):
+        os.utime(path, (path.stat().st_mtime - 60,) * 2)
+    routing._run_cached_stage("calculate_orog", None, (topo, topo_key))
+    routing._run_cached_stage(
+        "calculate_trip", None, (topo, topo_key), (omsk, omsk_key)
+    )
+    cached_keys = set(path.stem for path in (tmp_path / "lru").glob("*.npz"))
+    assert len(cached_keys) == 2
+    assert omsk_key not in cached_keys and orog_key in cached_keys
+
+    # Results of another version of the code are not loaded
+    monkeypatch.setattr(routing, "cache_version", routing.cache_version + 1)
+    monkeypatch.setattr(routing, "_code_keys", {})
+    monkeypatch.setattr(routing, "calculate_omsk", fail)
+    with pytest.raises(AssertionError):
+        routing._run_cached_stage("calculate_omsk", None, (topo, topo_key))
+    monkeypatch.setattr(routing, "calculate_omsk", calculate_omsk)
+    assert (
+        routing._run_cached_stage("calculate_omsk", None, (topo, topo_key))[1]
+        != omsk_key
+    )
+
+
+def test_run_cached_stage_concurrent_workers(tmp_path, monkeypatch):
+    # Other workers share the cache directory and can remove results at any time
+    monkeypatch.setenv("ROUTING_CACHE_DIR", str(tmp_path))
+    topo = ds_runoff.topo.values
+    topo_key = routing.get_cache_key(topo)
+    omsk, omsk_key = routing._run_cached_stage("calculate_omsk", None, (topo, topo_key))
+
+    # A result removed before it is loaded is a cache miss
+    load = numpy.load
+
+    def removed(path, *args, **kwargs):
+        os.remove(path)
+        return load(path, *args, **kwargs)
+
+    monkeypatch.setattr(numpy, "load", removed)
+    profile = routing.RoutingProfile(log=False)
+    cached, cached_key = routing._run_cached_stage(
+        "calculate_omsk", None, (topo, topo_key), profile=profile
+    )
+    monkeypatch.setattr(numpy, "load", load)
+    assert cached_key == omsk_key and numpy.all(cached == omsk)
+    assert not profile.stages[0]["cached"]
+    assert (tmp_path / f"{omsk_key}.npz").exists()
+
+    # Results removed while the cache is evicted are skipped
+    listdir = os.listdir
+    monkeypatch.setattr(
+        os, "listdir", lambda path: listdir(path) + ["removed.npz", "removed_too.npz"]
+    )
+    monkeypatch.setenv("ROUTING_CACHE_SIZE", "0")
+    routing._evict_cache(str(tmp_path))
+    monkeypatch.setattr(os, "listdir", listdir)
+    assert not list(tmp_path.glob("*.npz"))
+
+    # The temporary file is removed when writing the result fails
+    def fail(*args, **kwargs):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(numpy, "savez", fail)
+    with pytest.raises(OSError, match="No space left"):
+        routing._run_cached_stage("calculate_omsk", None, (topo, topo_key))
+    assert not list(tmp_path.iterdir())
+
+
+def test_update_routing(tmp_path, monkeypatch):
+    topo, latitudes = ds_input.topo.values, ds_input.lat.values
+    previous = routing._calculate_routing(topo, latitudes)
+
+    # Raise a few mountain cells
+    edited_topo = topo.copy()
+    edited_topo[120:123, 101:103] += 300
+    changed = edited_topo != topo
+    ds_routing = routing.update_routing(previous, edited_topo, latitudes, changed)
+    assert not numpy.array_equal(ds_routing.topo.values, previous.topo.values)
+    expected = routing._calculate_routing(edited_topo, latitudes)
+    for variable in expected.data_vars:
+        numpy.testing.assert_array_equal(
+            ds_routing[variable].values, expected[variable].values
+        )
+
+    # The checksum still matches once the file is written
+    path = tmp_path / "routing.nc"
+    previous.to_netcdf(path, format="NETCDF3_64BIT")
+    with xr.open_dataset(path) as ds:
+        assert routing.update_routing(ds, edited_topo, latitudes) is not None
+
+    # Only the vectorized stages can be run on the affected basins
+    assert (
+        routing.update_routing(
+            previous, edited_topo, latitudes, backend={"fix_topo": "reference"}
+        )
+        is None
+    )
+    # Routing most of the land again needs a full run
+    monkeypatch.setenv("ROUTING_UPDATE_FRACTION", "0")
+    assert routing.update_routing(previous, edited_topo, latitudes) is None
+    monkeypatch.delenv("ROUTING_UPDATE_FRACTION")
+
+    # A file edited by hand needs a full run
+    edited = previous.copy(deep=True)
+    edited.basins.values[edited.basins.values == 7] = 8
+    assert routing.update_routing(edited, edited_topo, latitudes) is None
+    # run_routines does a full run when the update fails
+    edited.attrs["routing_checksum"] = routing._get_routing_checksum(edited)
+    ds_routing = routing.run_routines(edited_topo, latitudes, previous=edited)[0]
+    xr.testing.assert_identical(ds_routing, expected)
+
+    # Moving the coast line needs a full run
+    coast_topo = edited_topo.copy()
+    coast_topo[60, 300] = 100
+    assert routing.update_routing(previous, coast_topo, latitudes) is None
+
+    # The cached stages are loaded instead of updating the routing
+    monkeypatch.setenv("ROUTING_CACHE_DIR", str(tmp_path / "cache"))
+    routing.run_routines(edited_topo, latitudes)
+    updates = []
+    monkeypatch.setattr(routing, "update_routing", lambda *args: updates.append(args))
+    ds_routing = routing.run_routines(edited_topo, latitudes, previous=previous)[0]
+    xr.testing.assert_identical(ds_routing, expected)
+    assert not updates
+
+
+def test_routing_resolution():
+    # Grid cells cover the whole globe at any resolution
+    for shape in ((180, 360), (360, 720), (720, 1440)):
+        rlon, rlat = routing.calculate_curvilinear_coordinates(shape)
+        assert rlon.shape == shape and rlat.shape == shape
+        area = routing.calculate_area(rlat)
+        assert abs(area.sum() / (4 * numpy.pi * 6370**2) - 1) < 10e-4
+
+    # Route the topography at 0.5 degrees
+    topo = numpy.repeat(numpy.repeat(ds_input.topo.values, 2, axis=0), 2, axis=1)
+    latitudes = numpy.arange(-89.75, 90, 0.5)
+    ds_routing, ds_bathy, ds_soils, ds_topo_high_res = routing.run_routines(
+        topo, latitudes
+    )
+    assert ds_routing.trip.shape == (360, 720)
+    assert ds_routing.nav_lat.values[0, 0] == 89.75
+    assert ds_soils.soilcolor.shape == (360, 720)
+    assert ds_topo_high_res.RELIEF.shape == (1080, 2160)
+
+
+def test_get_band_differences(monkeypatch):
+    topo = ds_runoff.topo.values
+    expected = routing.get_differences_with_neighbors(topo, ensure_gradient=True)
+    # Bands of 2 rows, the last band only has one row
+    monkeypatch.setenv("ROUTING_BAND_CELLS", str(2 * topo.shape[1] + 1))
+    bands = routing._get_bands((179, 360))
+    assert len(bands) == 90 and bands[-1] == slice(178, 179)
+    bands = routing._get_bands(topo.shape)
+    assert len(bands) == 90
+    differences = numpy.concatenate(
+        [
+            routing._get_band_differences(topo, rows, ensure_gradient=True)
+            for rows in bands
+        ],
+        axis=1,
+    )
+    assert numpy.all(differences == expected)
+
+    # Stages give the same results whatever the size of the bands
+    omsk = routing.calculate_omsk(topo)
+    trip = routing.calculate_trip(topo, omsk)
+    monkeypatch.delenv("ROUTING_BAND_CELLS")
+    assert nan_equal(trip, routing.calculate_trip(topo, omsk))